@@ -0,0 +1,147 @@
+# Admission control: a limit on how many requests a path operation handles at once
+# Without it every request starts right away, so a burst of slow requests (a big PUT, a model prediction) fills the
+# event loop and the thread pool, and every route gets slow together, even cheap ones like /users/me
+
+# Turn it on for a path operation with @admission.limit(concurrency=..., queue=..., timeout=...) under the @app.get(...) line
+# Only that many requests run at once, the next ones wait in a queue of at most `queue` requests, in the order they arrived
+# A request that waited `timeout` seconds, or that finds the queue full, gets a 503 with a Retry-After header right away,
+# instead of making everyone wait longer. Path operations without a limit aren't affected at all
+# stats() has the running and queued requests and how many were turned away for each limited route, main.py serves it at /admission
+
+# It's a route hook (see route_hooks.py) registered before the response cache, so cache hits don't take a slot
+# The time a request waited for its slot goes in endpoint_timings as "admission_wait", /metrics has it as its own phase
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+from route_hooks import Handler, endpoint_timings, route_option
+
+OPTION = "__admission__"
+
+
+class Gate:
+    # The slots and wait queue of one path operation
+    def __init__(self, concurrency: int, queue: int, timeout: float) -> None:
+        self.concurrency = concurrency
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0 # the queue was full
+        self.timed_out = 0 # waited longer than timeout
+        self._waiters: deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> bool:
+        # True when the request got a slot, False when it should be turned away
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.queue:
+            self.rejected += 1
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return self._give_up(waiter)
+        except asyncio.CancelledError:
+            self._give_up(waiter)
+            raise
+        self.admitted += 1
+        return True
+
+    def _give_up(self, waiter: asyncio.Future) -> bool:
+        if waiter.done():
+            # release() handed this request a slot just as it gave up, so pass the slot on
+            self.release()
+        else:
+            waiter.cancel()
+            self._waiters.remove(waiter)
+        return False
+
+    def release(self) -> None:
+        # The slot goes straight to the next waiting request, so active doesn't change
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> int:
+        # Roughly when there's room again: the time a full queue takes to get a slot
+        return max(1, math.ceil(self.timeout))
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queued": len(self._waiters),
+            "queue_size": self.queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "shed": self.rejected + self.timed_out,
+        }
+
+
+class AdmissionControl:
+    def __init__(self) -> None:
+        self.gates: dict[str, Gate] = {} # "METHOD path" -> Gate
+
+    def limit(self, concurrency: int, queue: int = 0, timeout: float = 1.0) -> Callable:
+        return route_option(OPTION, concurrency=concurrency, queue=queue, timeout=timeout)
+
+    def add_routes(self, routes: list) -> None:
+        # Makes the gates of the limited routes up front (main.py does it when the app starts),
+        # so stats() lists them before they handle their first request
+        for route in routes:
+            if isinstance(route, APIRoute):
+                self.gate(route)
+
+    def gate(self, route: APIRoute) -> Gate | None:
+        options = getattr(route.endpoint, OPTION, None)
+        if options is None:
+            return None
+        key = f"{','.join(sorted(route.methods))} {route.path}"
+        gate = self.gates.get(key)
+        if gate is None:
+            gate = self.gates[key] = Gate(**options)
+        return gate
+
+    def hook(self, route: APIRoute, handler: Handler) -> Handler:
+        gate = self.gate(route)
+        if gate is None:
+            return handler
+
+        async def admitted_handler(request: Request) -> Response:
+            timings = endpoint_timings.get()
+            start = time.perf_counter()
+            admitted = await gate.acquire()
+            if timings is not None:
+                timings["admission_wait"] = time.perf_counter() - start
+            if not admitted:
+                return JSONResponse(
+                    {"detail": "Too many requests for this path, try again later"},
+                    status_code=503,
+                    headers={"retry-after": str(gate.retry_after())},
+                )
+            try:
+                return await handler(request)
+            finally:
+                gate.release()
+
+        return admitted_handler
+
+    def stats(self) -> dict:
+        return {route: gate.stats() for route, gate in self.gates.items()}
@@ -0,0 +1,147 @@
+# Runs many requests to the app in one HTTP request, for clients that need several routes to show one screen
+# POST /batch with {"requests": [{"method": "GET", "path": "/users/me"}, {"method": "GET", "path": "/models/alexnet"}, ...]}
+# answers {"responses": [{"status": 200, "headers": {...}, "body": {...}}, ...]}, in the same order as the requests
+
+# The requests don't go over the network again: each one is passed straight to the app as an ASGI call,
+# so it goes through the same routing, validation, hooks (cache, metrics, ...) and error handling as a normal request
+# They run concurrently, at most `concurrency` at a time, or one after the other with "ordered": true when one depends on another
+# A request that takes longer than `timeout` seconds (e.g. a stream that doesn't end, like /items/changes without a limit) gets a 504
+# A response body is kept in memory until the batch answers, so one larger than `max_response_bytes` is cut off with a 413
+
+# JSON bodies are put in the answer as JSON and text bodies as a string. Anything else (an image, a file from /files/...)
+# can't go in JSON as it is, so it's base64 encoded and the response has "body_encoding": "base64"
+
+import asyncio
+import base64
+import json
+from typing import Any
+from urllib.parse import unquote, urlsplit
+
+from pydantic import BaseModel, Field
+from starlette.types import ASGIApp, Message, Scope
+
+BATCH_PATH = "/batch"
+TEXT_TYPES = ("text/", "application/xml", "application/javascript", "application/x-ndjson")
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+def is_text(content_type: str) -> bool:
+    media_type = content_type.split(";")[0].strip().lower()
+    return media_type.startswith(TEXT_TYPES) or media_type.endswith(("+json", "+xml"))
+
+
+class SubRequest(BaseModel):
+    method: str = "GET"
+    path: str = Field(pattern=r"^/") # with the query, like /users/1/items/foo?short=true
+    headers: dict[str, str] = {}
+    body: Any = None # sent as JSON when it's set
+
+
+class BatchRequest(BaseModel):
+    requests: list[SubRequest] = Field(min_length=1, max_length=50)
+    ordered: bool = False
+
+
+class BatchRunner:
+    def __init__(self, app: ASGIApp, concurrency: int = 8, timeout: float = 10.0, max_response_bytes: int = 1024 * 1024) -> None:
+        self.app = app
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_response_bytes = max_response_bytes
+
+    async def run(self, batch: BatchRequest, parent: Scope) -> dict:
+        semaphore = asyncio.Semaphore(1 if batch.ordered else self.concurrency)
+
+        async def limited(request: SubRequest) -> dict:
+            async with semaphore:
+                return await self.call(request, parent)
+
+        responses = await asyncio.gather(*(limited(request) for request in batch.requests))
+        return {"responses": responses}
+
+    async def call(self, request: SubRequest, parent: Scope) -> dict:
+        url = urlsplit(request.path)
+        path = unquote(url.path) # decoded like a server does, so /users/john%20doe gives "john doe"
+        if path.rstrip("/") == BATCH_PATH:
+            return {"status": 400, "headers": {}, "body": {"detail": "a batch can't contain another batch"}}
+        body = b""
+        headers = {name.lower(): value for name, value in request.headers.items()}
+        if request.body is not None:
+            body = json.dumps(request.body, separators=(",", ":")).encode()
+            headers.setdefault("content-type", "application/json")
+        headers["content-length"] = str(len(body))
+        try:
+            raw_headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+        except UnicodeEncodeError:
+            # HTTP headers are latin-1, a header that isn't can't be sent, like a client couldn't send it either
+            return {"status": 400, "headers": {}, "body": {"detail": "header names and values must be latin-1"}}
+        scope = {
+            "type": "http",
+            "asgi": parent.get("asgi", {"version": "3.0"}),
+            "http_version": parent.get("http_version", "1.1"),
+            "method": request.method.upper(),
+            "scheme": parent.get("scheme", "http"),
+            "server": parent.get("server"),
+            "client": parent.get("client"),
+            "root_path": parent.get("root_path", ""),
+            "path": path,
+            "raw_path": url.path.encode(),
+            "query_string": url.query.encode(),
+            "headers": raw_headers,
+            "state": dict(parent.get("state", {})), # the lifespan state, like a normal request gets
+        }
+        received = False
+        status = 500
+        response_headers: list[tuple[bytes, bytes]] = []
+        chunks: list[bytes] = []
+        size = 0
+        finished = asyncio.Event()
+
+        async def receive() -> Message:
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await finished.wait() # like a client that stays connected until the response is complete
+            return {"type": "http.disconnect"}
+
+        async def send(message: Message) -> None:
+            nonlocal status, response_headers, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers = message.get("headers", [])
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                size += len(chunk)
+                if size > self.max_response_bytes:
+                    raise ResponseTooLarge() # stops the app, like a client closing the connection
+                chunks.append(chunk)
+                if not message.get("more_body", False):
+                    finished.set()
+
+        try:
+            await asyncio.wait_for(self.app(scope, receive, send), self.timeout)
+        except asyncio.TimeoutError:
+            return {"status": 504, "headers": {}, "body": {"detail": f"the request took longer than {self.timeout} seconds"}}
+        except ResponseTooLarge:
+            return {"status": 413, "headers": {}, "body": {"detail": f"the response is larger than {self.max_response_bytes} bytes"}}
+        except Exception:
+            # The app already sent its 500 response (Starlette's ServerErrorMiddleware does before raising), it's used below
+            if not response_headers:
+                return {"status": 500, "headers": {}, "body": {"detail": "Internal Server Error"}}
+        finally:
+            finished.set()
+        decoded_headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in response_headers}
+        content = b"".join(chunks)
+        content_type = decoded_headers.get("content-type", "")
+        if content_type.startswith("application/json") and content:
+            return {"status": status, "headers": decoded_headers, "body": json.loads(content)}
+        if not content_type or is_text(content_type):
+            try:
+                return {"status": status, "headers": decoded_headers, "body": content.decode()}
+            except UnicodeDecodeError:
+                pass # not UTF-8 after all
+        return {"status": status, "headers": decoded_headers, "body": base64.b64encode(content).decode(), "body_encoding": "base64"}
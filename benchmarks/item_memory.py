@@ -0,0 +1,111 @@
+# Compares how much memory the items take in ItemStore, the way main.py keeps them:
+#   store: ItemStore(), one pydantic Item per item, the default
+#   store columnar: ItemStore(ItemColumns()), what ITEMS_COLUMNAR=1 does
+#   store shared: ItemStore(SharedItems(...).records), what SHARED_ITEMS does, per worker. The mapped file isn't counted, it's shared by the workers
+# All include the store's own indexes (the sorted ids, names and prices), which hold Python objects per item in either layout
+# For reference it also measures the records alone: a dict per item (like item_dict in create_item), Item objects and ItemColumns
+# Run it from the folder with main.py: python -m benchmarks.item_memory -n 1000000
+# The indexes other features keep from the store's listeners (search, tags, aggregates...) aren't included, they're the same in both layouts
+
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+from typing import Callable
+
+from item_columns import ItemColumns
+from item_store import ItemStore
+from main import Item
+from shared_items import SharedItems
+
+TAGS = [[], ["sale"], ["new"], ["sale", "new"], ["books"], ["toys", "sale"]]
+
+
+def make_item(i: int) -> Item:
+    return Item(
+        name=f"Item {i}",
+        description=f"This is item number {i}, an amazing item" if i % 3 else None,
+        price=float(i % 1000) + 0.99,
+        tax=float(i % 7) if i % 2 else None,
+        tags=TAGS[i % len(TAGS)],
+    )
+
+
+def as_dicts(count: int) -> dict:
+    return {i: {"item_id": i, **make_item(i).model_dump()} for i in range(1, count + 1)}
+
+
+def as_items(count: int) -> dict:
+    return {i: make_item(i) for i in range(1, count + 1)}
+
+
+def as_columns(count: int) -> ItemColumns:
+    columns = ItemColumns()
+    for i in range(1, count + 1):
+        columns[i] = make_item(i)
+    return columns
+
+
+def as_store(count: int) -> ItemStore:
+    store = ItemStore()
+    for i in range(1, count + 1):
+        store.put(i, make_item(i))
+    return store
+
+
+def as_columnar_store(count: int) -> ItemStore:
+    store = ItemStore(ItemColumns())
+    for i in range(1, count + 1):
+        store.put(i, make_item(i))
+    return store
+
+
+def as_shared_store(count: int) -> tuple[ItemStore, SharedItems]:
+    path = os.path.join(tempfile.mkdtemp(), "items")
+    shared = SharedItems(path, capacity=count)
+    os.unlink(path) # the mapping stays until shared is closed
+    store = ItemStore(shared.records)
+    shared.attach(store, Item)
+    shared.sync()
+    for i in range(1, count + 1):
+        shared.put(i, make_item(i))
+    return store, shared
+
+
+def measure(build: Callable[[int], object], count: int) -> int:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(count)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--items", type=int, default=200_000, help="how many items to keep")
+    args = parser.parse_args()
+    layouts = (
+        ("store", as_store),
+        ("store columnar", as_columnar_store),
+        ("store shared", as_shared_store),
+        ("dicts", as_dicts),
+        ("items", as_items),
+        ("columns", as_columns),
+    )
+    results = {name: measure(build, args.items) for name, build in layouts}
+    baseline = results["store"]
+    print(f"{'layout':15} {'MB':>10} {'bytes/item':>11} {'vs store':>9}")
+    for name, used in results.items():
+        if name == "dicts":
+            print("records only:")
+        print(f"{name:15} {used / 1e6:10.1f} {used / args.items:11.0f} {used / baseline:9.2f}")
+    print(f"columns breakdown: {as_columns(min(args.items, 1000)).nbytes()} for {min(args.items, 1000)} items")
+
+
+if __name__ == "__main__":
+    main()
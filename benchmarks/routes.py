@@ -0,0 +1,189 @@
+# Load and latency benchmark for every path operation in main.py
+# Run it from the folder with main.py: python -m benchmarks.routes
+# The requests go straight to the app through httpx's ASGI transport, so there's no network in the numbers
+
+# Every route is sent --requests requests, --concurrency of them at a time, and gets its p50/p95/p99 latency and requests per second
+# --output writes the results as JSON, and a results file can be used as the --baseline of a later run
+# With a baseline, the run fails (exit code 1) when a route's p95 latency went up, or its throughput went down, by more than --threshold
+
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+import httpx
+
+ITEM = {
+    "name": "Foo",
+    "description": "This is an amazing item that has a long description",
+    "price": 35.4,
+    "tax": 3.2,
+}
+
+BATCH = {
+    "requests": [
+        {"path": "/users/me"},
+        {"path": "/users/1/items/foo?short=true"},
+        {"path": "/items/1?needy=yes"},
+        {"path": "/models/alexnet"},
+    ]
+}
+
+PREDICT = {"inputs": [[(i % 255) / 255 for i in range(784)]]}
+
+# Files for /files/{file_path:path}, main.py reads FILES_ROOT when it's imported so this has to happen first
+FILES_ROOT = tempfile.mkdtemp(prefix="bench-files-")
+atexit.register(shutil.rmtree, FILES_ROOT, ignore_errors=True)
+with open(os.path.join(FILES_ROOT, "small.txt"), "wb") as file:
+    file.write(b"x" * 4096)
+os.environ["FILES_ROOT"] = FILES_ROOT
+# The profile routes need the token, and a profile to read
+os.environ.setdefault("PROFILE_TOKEN", "benchmark")
+PROFILE_HEADERS = {"x-profile": os.environ["PROFILE_TOKEN"]}
+
+from main import app  # noqa: E402
+
+Send = Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+# One entry per path operation in main.py, keyed as "METHOD path"
+# The query changes on every request for the cached GET routes so that the path operation really runs
+ROUTES: dict[str, Send] = {
+    "GET /users/me": lambda client, i: client.get("/users/me"),
+    "GET /users/{user_id}": lambda client, i: client.get(f"/users/{i}"),
+    "GET /users": lambda client, i: client.get("/users"),
+    "GET /models/{model_name}": lambda client, i: client.get("/models/alexnet", params={"n": i}),
+    "GET /files/{file_path:path}": lambda client, i: client.get("/files/small.txt"),
+    "GET /users/{user_id}/items/{item_id}": lambda client, i: client.get(f"/users/{i}/items/foo", params={"q": "bar"}),
+    "GET /items/{item_id}": lambda client, i: client.get(f"/items/{i % 100 + 1}", params={"needy": "sooooneedy", "n": i}),
+    "POST /items/": lambda client, i: client.post("/items/", json=ITEM),
+    "POST /items/bulk": lambda client, i: client.post("/items/bulk", content=b"\n".join([json.dumps(ITEM).encode()] * 10)),
+    "PUT /items/{item_id}": lambda client, i: client.put(f"/items/{i % 100 + 1}", json=ITEM, params={"q": "fixedquery"}),
+    "GET /items/aggregates": lambda client, i: client.get("/items/aggregates"),
+    "GET /items/changes": lambda client, i: client.get("/items/changes", params={"since": 0, "limit": 10}),
+    "GET /items/": lambda client, i: client.get("/items/", params={"limit": 20}),
+    "POST /batch": lambda client, i: client.post("/batch", json=BATCH),
+    "GET /metrics": lambda client, i: client.get("/metrics"),
+    "GET /admission": lambda client, i: client.get("/admission"),
+    "GET /profiles": lambda client, i: client.get("/profiles", headers=PROFILE_HEADERS),
+    "GET /profiles/{profile_id}": lambda client, i: client.get("/profiles/1", headers=PROFILE_HEADERS),
+    "POST /models/{model_name}/predict": lambda client, i: client.post("/models/lenet/predict", json=PREDICT),
+}
+
+
+def registered_routes() -> set[str]:
+    names = set()
+    for route in app.routes:
+        if not hasattr(route, "endpoint") or route.path in (app.openapi_url, app.docs_url, app.redoc_url, app.swagger_ui_oauth2_redirect_url):
+            continue
+        for method in sorted(getattr(route, "methods", None) or ()):
+            if method != "HEAD":
+                names.add(f"{method} {route.path}")
+    return names
+
+
+def percentile(latencies: list[float], percent: float) -> float:
+    return statistics.quantiles(latencies, n=100, method="inclusive")[percent - 1] if len(latencies) > 1 else latencies[0]
+
+
+async def run_route(client: httpx.AsyncClient, send: Send, requests: int, concurrency: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        for i in counter:
+            start = time.perf_counter()
+            response = await send(client, i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput": requests / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def run(routes: dict[str, Send], requests: int, concurrency: int, warmup: int) -> dict[str, dict]:
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        for i in range(100): # items for the GET and PUT item routes to find
+            await client.put(f"/items/{i + 1}", json=ITEM)
+        await client.get("/users/me", headers=PROFILE_HEADERS) # profile 1
+        for name, send in routes.items():
+            if warmup:
+                await run_route(client, send, warmup, concurrency)
+            results[name] = await run_route(client, send, requests, concurrency)
+    return results
+
+
+def regressions(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            found.append(f"{name}: p95 {before['p95_ms']:.3f}ms -> {result['p95_ms']:.3f}ms")
+        if result["throughput"] < before["throughput"] * (1 - threshold):
+            found.append(f"{name}: throughput {before['throughput']:.0f}/s -> {result['throughput']:.0f}/s")
+    return found
+
+
+def print_table(results: dict[str, dict]) -> None:
+    print(f"{'route':40} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    for name, r in results.items():
+        print(f"{name:40} {r['throughput']:9.0f} {r['p50_ms']:8.3f} {r['p95_ms']:8.3f} {r['p99_ms']:8.3f} {r['errors']:6}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=2000, help="requests per route")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="requests in flight at a time")
+    parser.add_argument("--warmup", type=int, default=100, help="requests per route before measuring")
+    parser.add_argument("--routes", nargs="*", help="only run these routes, like 'GET /users/me'")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed regression, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    missing = registered_routes() - ROUTES.keys()
+    if missing:
+        print(f"routes without a benchmark: {', '.join(sorted(missing))}", file=sys.stderr)
+    routes = {name: ROUTES[name] for name in args.routes} if args.routes else ROUTES
+
+    results = asyncio.run(run(routes, args.requests, args.concurrency, args.warmup))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(results, json.load(file), args.threshold)
+        for line in found:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
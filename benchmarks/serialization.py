@@ -0,0 +1,54 @@
+# Compares requests per second of create_item, update_item and get_model with app.state.fast_json off and on
+# Run it from the folder with main.py: python -m benchmarks.serialization
+# The requests go straight to the app through httpx's ASGI transport, so there's no network in the numbers
+
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from main import app
+
+ITEM = {
+    "name": "Foo",
+    "description": "This is an amazing item that has a long description",
+    "price": 35.4,
+    "tax": 3.2,
+}
+
+REQUESTS = {
+    "POST /items/": lambda client, i: client.post("/items/", json=ITEM),
+    "PUT /items/{item_id}": lambda client, i: client.put(f"/items/{i % 100 + 1}", json=ITEM, params={"q": "fixedquery"}),
+    # A different query every time so the response cache misses and get_model runs
+    "GET /models/{model_name}": lambda client, i: client.get("/models/lenet", params={"n": i}),
+}
+
+
+async def requests_per_second(client: httpx.AsyncClient, send, count: int) -> float:
+    for i in range(min(count, 100)): # warm up
+        await send(client, i)
+    start = time.perf_counter()
+    for i in range(count):
+        response = await send(client, i)
+        response.raise_for_status()
+    return count / (time.perf_counter() - start)
+
+
+async def main(count: int) -> None:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        print(f"{'route':28} {'default':>10} {'fast_json':>10} {'gain':>7}")
+        for name, send in REQUESTS.items():
+            results = []
+            for fast in (False, True):
+                app.state.fast_json = fast
+                results.append(await requests_per_second(client, send, count))
+            print(f"{name:28} {results[0]:10.0f} {results[1]:10.0f} {results[1] / results[0] - 1:+7.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--requests", type=int, default=5000, help="requests per route and mode")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
@@ -0,0 +1,209 @@
+# Bulk loading of items for POST /items/bulk in main.py
+# create_item handles one Item per request, so loading a big catalog pays the request overhead once per item
+# Here the request body is read as a stream, so only one chunk of items is ever held in memory, no matter how big the upload is
+
+# The body can be NDJSON (one JSON object per line) or a JSON array of objects
+# Rows are validated a chunk at a time with one TypeAdapter call. Only a chunk with a bad row is validated again row by row to find out which rows failed
+# price_with_tax is worked out for the whole chunk at once with NumPy, instead of the if item.tax branch for every item
+# The response reports how many rows were stored and the errors of the rows that weren't (up to max_errors of them)
+
+import codecs
+import json
+import re
+from typing import Any, AsyncIterator
+
+import numpy as np
+from pydantic import BaseModel, TypeAdapter, ValidationError
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 100
+MAX_ROW_BYTES = 1 << 20 # a single row bigger than this is rejected instead of buffered
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+_WHITESPACE_RUN = re.compile(r"[ \t\r\n]*")
+
+
+class BodyError(ValueError):
+    # Raised when the body can't be read any further, e.g. a JSON array that is cut off
+    pass
+
+
+async def iter_rows(body: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, Any]]:
+    # Yields (row number, parsed JSON value). A row that isn't valid JSON is yielded as the JSONDecodeError
+    # Rows are read from buffer at pos instead of slicing the rest of the buffer off after every row, which would copy it
+    # once per row. The rows already read are only dropped when the next chunk comes in
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    pos = 0
+    chunks = aiter(body)
+    done = False
+
+    async def fill() -> bool:
+        nonlocal buffer, pos, done
+        if done:
+            return False
+        try:
+            chunk = await anext(chunks)
+        except StopAsyncIteration:
+            buffer += text.decode(b"", final=True)
+            done = True
+            return False
+        buffer = buffer[pos:] + text.decode(chunk)
+        pos = 0
+        return True
+
+    def skip_whitespace() -> None:
+        nonlocal pos
+        pos = _WHITESPACE_RUN.match(buffer, pos).end()
+
+    # Find out if it's a JSON array or NDJSON from the first character
+    while not buffer.lstrip(_WHITESPACE) and await fill():
+        pass
+    skip_whitespace()
+    if pos == len(buffer):
+        return
+
+    row = 0
+    if buffer[pos] != "[":
+        while True:
+            newline = buffer.find("\n", pos)
+            if newline == -1:
+                if len(buffer) - pos > MAX_ROW_BYTES:
+                    raise BodyError(f"row {row} is longer than {MAX_ROW_BYTES} bytes")
+                if await fill():
+                    continue
+                newline = len(buffer)
+            line = buffer[pos:newline]
+            pos = newline + 1
+            if line.strip():
+                try:
+                    yield row, json.loads(line)
+                except json.JSONDecodeError as exc:
+                    yield row, exc
+                row += 1
+            if done and pos >= len(buffer):
+                return
+
+    pos += 1
+    while True:
+        skip_whitespace()
+        if row and buffer.startswith(",", pos):
+            pos += 1
+            skip_whitespace()
+        if buffer.startswith("]", pos):
+            return
+        try:
+            value, end = _decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as exc:
+            # The row may just be cut in half by the chunk boundary, read more and try again
+            if len(buffer) - pos > MAX_ROW_BYTES:
+                raise BodyError(f"row {row} is longer than {MAX_ROW_BYTES} bytes")
+            if await fill():
+                continue
+            row_error = json.JSONDecodeError(exc.msg, buffer[pos:], exc.pos - pos) # with the position in the row, not in the buffer
+            raise BodyError(f"row {row}: {row_error}")
+        # A value that ends at the end of the buffer could be a number that continues in the next chunk
+        if end == len(buffer) and not done and await fill():
+            continue
+        yield row, value
+        row += 1
+        pos = end
+
+
+def prices_with_tax(items: list[BaseModel]) -> np.ndarray:
+    # Same rule as create_item: price + tax when tax is set and not 0, otherwise NaN (no price_with_tax)
+    prices = np.fromiter((item.price for item in items), dtype=np.float64, count=len(items))
+    taxes = np.fromiter(
+        (item.tax if item.tax is not None else 0.0 for item in items),
+        dtype=np.float64,
+        count=len(items),
+    )
+    return np.where(taxes != 0.0, prices + taxes, np.nan)
+
+
+class BulkIngest:
+    def __init__(
+        self,
+        model: type[BaseModel],
+        store: Any,
+        chunk_size: int = CHUNK_SIZE,
+        max_errors: int = MAX_ERRORS,
+    ) -> None:
+        self.model = model
+        self.store = store
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self._chunk_adapter = TypeAdapter(list[model])
+
+    async def run(self, body: AsyncIterator[bytes]) -> dict:
+        report = {
+            "received": 0,
+            "inserted": 0,
+            "rejected": 0,
+            "item_ids": [], # [first, last] ranges of the ids given to the new items
+            "price_with_tax_total": 0.0,
+            "errors": [],
+            "errors_truncated": False,
+        }
+        rows: list[int] = []
+        values: list[Any] = []
+        try:
+            async for row, value in iter_rows(body):
+                report["received"] += 1
+                if isinstance(value, json.JSONDecodeError):
+                    self._error(report, row, [{"type": "json_invalid", "msg": str(value)}])
+                    continue
+                rows.append(row)
+                values.append(value)
+                if len(values) >= self.chunk_size:
+                    self._store_chunk(report, rows, values)
+                    rows, values = [], []
+        except BodyError as exc:
+            report["body_error"] = str(exc)
+        if values:
+            self._store_chunk(report, rows, values)
+        return report
+
+    def _store_chunk(self, report: dict, rows: list[int], values: list[Any]) -> None:
+        try:
+            items = self._chunk_adapter.validate_python(values)
+            item_rows = rows
+        except ValidationError:
+            items = []
+            item_rows = []
+            for row, value in zip(rows, values):
+                try:
+                    items.append(self.model.model_validate(value))
+                    item_rows.append(row)
+                except ValidationError as exc:
+                    self._error(
+                        report,
+                        row,
+                        exc.errors(include_url=False, include_context=False, include_input=False),
+                    )
+        ids = report["item_ids"]
+        stored = []
+        for row, item in zip(item_rows, items):
+            try:
+                item_id = self.store.insert(item)
+            except ValueError as exc: # the store can refuse an item too, e.g. shared_items.SharedItems
+                self._error(report, row, [{"type": "store", "msg": str(exc)}])
+                continue
+            stored.append(item)
+            if ids and ids[-1][1] == item_id - 1:
+                ids[-1][1] = item_id
+            else:
+                ids.append([item_id, item_id])
+        if not stored:
+            return
+        with_tax = prices_with_tax(stored)
+        report["price_with_tax_total"] += float(np.nansum(with_tax))
+        report["inserted"] += len(stored)
+
+    def _error(self, report: dict, row: int, errors: list) -> None:
+        report["rejected"] += 1
+        if len(report["errors"]) < self.max_errors:
+            report["errors"].append({"row": row, "errors": errors})
+        else:
+            report["errors_truncated"] = True
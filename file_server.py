@@ -0,0 +1,152 @@
+# Serving files for GET /files/{file_path:path} in main.py
+# The file_path is looked up inside one root directory (the FILES_ROOT environment variable, ./files by default)
+
+# Starlette's FileResponse already does the heavy lifting for big files:
+# It answers Range requests, including several ranges at once as multipart/byteranges, so downloads can be resumed
+# It sends the file a chunk at a time, so a big download is never read into memory as a whole
+# If the server supports the ASGI pathsend extension, it hands the server the path and the server sends the file itself (zero copy)
+
+# On top of that, this module:
+# Blocks path traversal. The path is resolved (following symlinks) and has to stay inside the root, so /files/../../etc/passwd is a 404
+# Caches os.stat results for a short time, so repeated requests for the same file don't hit the filesystem for every request
+# Memory maps small files that keep getting requested, so they are read straight from the page cache instead of through a thread for every chunk
+# Files under the root should be replaced (write a new file and rename it over the old one), not truncated in place, because a
+# memory map of a file that shrinks can't be read past the new end
+
+import mmap
+import os
+import stat
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse
+
+STAT_TTL = 2.0 # seconds a stat result is trusted before checking the file again
+STAT_CACHE_SIZE = 4096
+MMAP_MAX_FILE_SIZE = 256 * 1024
+MMAP_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class MmapReader:
+    # Reads from a memory map the way FileResponse reads from its file (seek and read)
+    def __init__(self, view: memoryview) -> None:
+        self._view = view
+        self._position = 0
+
+    async def seek(self, position: int) -> None:
+        self._position = position
+
+    async def read(self, size: int) -> bytes:
+        chunk = self._view[self._position : self._position + size]
+        self._position += len(chunk)
+        return bytes(chunk)
+
+
+class MmapFileResponse(FileResponse):
+    # A FileResponse that reads from a memory map. Range handling, headers and HEAD requests all come from FileResponse
+    # _open_file is the method FileResponse uses to open the file, so only the reading is changed
+    def __init__(self, path: str, mapped: mmap.mmap, **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self._mapped = mapped
+
+    @asynccontextmanager
+    async def _open_file(self) -> AsyncIterator[MmapReader]:
+        with memoryview(self._mapped) as view:
+            yield MmapReader(view)
+
+
+class FileServer:
+    def __init__(
+        self,
+        root: str,
+        stat_ttl: float = STAT_TTL,
+        mmap_max_file_size: int = MMAP_MAX_FILE_SIZE,
+        mmap_cache_bytes: int = MMAP_CACHE_BYTES,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.root = os.path.realpath(root)
+        self.stat_ttl = stat_ttl
+        self.mmap_max_file_size = mmap_max_file_size
+        self.mmap_cache_bytes = mmap_cache_bytes
+        self.clock = clock
+        # file_path -> (real path, stat result or None if there's no such file, time it was checked)
+        self._stats: OrderedDict[str, tuple[str, os.stat_result | None, float]] = OrderedDict()
+        # real path -> (stat result the map was made from, memory map)
+        self._maps: OrderedDict[str, tuple[os.stat_result, mmap.mmap]] = OrderedDict()
+        self._mapped_bytes = 0
+
+    def resolve(self, file_path: str) -> str | None:
+        # Returns the real path of file_path under the root, or None if it points outside of the root
+        if "\0" in file_path:
+            return None
+        path = os.path.realpath(os.path.join(self.root, file_path.lstrip("/")))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def stat(self, file_path: str) -> tuple[str, os.stat_result] | None:
+        now = self.clock()
+        cached = self._stats.get(file_path)
+        if cached is not None and now - cached[2] < self.stat_ttl:
+            self._stats.move_to_end(file_path)
+            path, stat_result, _ = cached
+        else:
+            path = self.resolve(file_path)
+            stat_result = None
+            if path is not None:
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    pass
+                if stat_result is not None and not stat.S_ISREG(stat_result.st_mode):
+                    stat_result = None
+            self._stats[file_path] = (path, stat_result, now)
+            self._stats.move_to_end(file_path)
+            if len(self._stats) > STAT_CACHE_SIZE:
+                self._stats.popitem(last=False)
+        if path is None or stat_result is None:
+            return None
+        return path, stat_result
+
+    def response(self, file_path: str) -> FileResponse:
+        found = self.stat(file_path)
+        if found is None:
+            raise HTTPException(status_code=404, detail="File not found")
+        path, stat_result = found
+        if 0 < stat_result.st_size <= self.mmap_max_file_size:
+            mapped = self._map(path, stat_result)
+            if mapped is not None:
+                return MmapFileResponse(path, mapped, stat_result=stat_result)
+        return FileResponse(path, stat_result=stat_result)
+
+    def _map(self, path: str, stat_result: os.stat_result) -> mmap.mmap | None:
+        cached = self._maps.get(path)
+        if cached is not None:
+            mapped_stat, mapped = cached
+            if (mapped_stat.st_mtime_ns, mapped_stat.st_size, mapped_stat.st_ino) == (
+                stat_result.st_mtime_ns,
+                stat_result.st_size,
+                stat_result.st_ino,
+            ):
+                self._maps.move_to_end(path)
+                return mapped
+            self._unmap(path)
+        try:
+            with open(path, "rb") as file:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        self._maps[path] = (stat_result, mapped)
+        self._mapped_bytes += stat_result.st_size
+        while self._mapped_bytes > self.mmap_cache_bytes:
+            self._unmap(next(iter(self._maps)))
+        return mapped
+
+    def _unmap(self, path: str) -> None:
+        # A response may still be reading from the map, so it isn't closed here
+        # It's closed when the last response using it is done and the map is garbage collected
+        mapped_stat, _ = self._maps.pop(path)
+        self._mapped_bytes -= mapped_stat.st_size
@@ -0,0 +1,223 @@
+# CPU inference for the models in ModelName, used by POST /models/{model_name}/predict in main.py
+# The models are small NumPy networks that take a 28x28 grayscale image flattened to 784 numbers and score the 10 digits:
+# lenet is LeNet-300-100 (784 -> 300 -> 100 -> 10), alexnet is a wider 784 -> 512 -> 256 -> 10 network,
+# and resnet has two residual blocks (x + relu(x @ w)) between its input and output layers
+# The weights are read from MODELS_DIR/<model_name>.npz when that file exists, otherwise they are made up from a fixed seed
+# so the networks give the same answers on every run
+
+# A model is only built the first time it is used, so the app starts fast and unused models take no memory
+
+# Requests aren't run one by one. Each model has a batcher: a request puts its inputs in a queue and waits,
+# and the batcher takes everything that arrived (up to max_batch_size inputs, waiting at most max_wait seconds
+# for more after the first one), runs one forward pass over all of it and hands every request its rows
+# One matrix multiplication over 64 rows costs far less than 64 multiplications over 1 row
+# The forward pass runs in a thread pool (NumPy lets go of the GIL while it multiplies), so the event loop keeps serving the other routes
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+
+INPUT_SIZE = 28 * 28
+CLASSES = 10
+MAX_BATCH_SIZE = 64
+MAX_WAIT = 0.002 # seconds
+
+
+def relu(x: np.ndarray) -> np.ndarray:
+    return np.maximum(x, 0, out=x)
+
+
+def softmax(x: np.ndarray) -> np.ndarray:
+    x = x - x.max(axis=1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=1, keepdims=True)
+    return x
+
+
+def dense(rng: np.random.Generator, inputs: int, outputs: int) -> tuple[np.ndarray, np.ndarray]:
+    # He initialization, the usual choice in front of a ReLU
+    weights = rng.standard_normal((inputs, outputs), dtype=np.float32) * np.float32(np.sqrt(2 / inputs))
+    return weights, np.zeros(outputs, dtype=np.float32)
+
+
+class MLP:
+    # A stack of dense layers with ReLU in between. Residual layers add their input back: x + relu(x @ w + b)
+    def __init__(self, layers: list[tuple[np.ndarray, np.ndarray]], residual: frozenset[int] = frozenset()) -> None:
+        self.layers = layers
+        self.residual = residual
+
+    def forward(self, x: np.ndarray) -> np.ndarray:
+        last = len(self.layers) - 1
+        for index, (weights, bias) in enumerate(self.layers):
+            out = x @ weights
+            out += bias
+            if index == last:
+                return softmax(out)
+            relu(out)
+            x = x + out if index in self.residual else out
+        return x
+
+    def save(self, path: str) -> None:
+        arrays = {}
+        for index, (weights, bias) in enumerate(self.layers):
+            arrays[f"w{index}"] = weights
+            arrays[f"b{index}"] = bias
+        np.savez(path, **arrays)
+
+    def load(self, path: str) -> None:
+        with np.load(path) as arrays:
+            for index, (weights, bias) in enumerate(self.layers):
+                if arrays[f"w{index}"].shape != weights.shape or arrays[f"b{index}"].shape != bias.shape:
+                    raise ValueError(f"{path}: layer {index} doesn't have the shape of this model")
+                self.layers[index] = (
+                    arrays[f"w{index}"].astype(np.float32),
+                    arrays[f"b{index}"].astype(np.float32),
+                )
+
+
+def build_lenet(rng: np.random.Generator) -> MLP:
+    return MLP([dense(rng, INPUT_SIZE, 300), dense(rng, 300, 100), dense(rng, 100, CLASSES)])
+
+
+def build_alexnet(rng: np.random.Generator) -> MLP:
+    return MLP([dense(rng, INPUT_SIZE, 512), dense(rng, 512, 256), dense(rng, 256, CLASSES)])
+
+
+def build_resnet(rng: np.random.Generator) -> MLP:
+    return MLP(
+        [dense(rng, INPUT_SIZE, 128), dense(rng, 128, 128), dense(rng, 128, 128), dense(rng, 128, CLASSES)],
+        residual=frozenset({1, 2}),
+    )
+
+
+BUILDERS: dict[str, Callable[[np.random.Generator], MLP]] = {
+    "alexnet": build_alexnet,
+    "resnet": build_resnet,
+    "lenet": build_lenet,
+}
+
+
+class Batcher:
+    def __init__(self, model: MLP, executor: Callable[[], ThreadPoolExecutor], max_batch_size: int, max_wait: float) -> None:
+        self.model = model
+        self.executor = executor # returns the registry's current thread pool
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0 # forward passes run, to see how well requests get merged
+        self.rows = 0
+        self._queue: asyncio.Queue[tuple[np.ndarray, asyncio.Future]] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    async def predict(self, inputs: np.ndarray) -> np.ndarray:
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            # A task left on an event loop that was closed (e.g. by an earlier TestClient) is never done and never runs again,
+            # so this loop gets its own task, and its own queue because an asyncio.Queue belongs to the loop it was first used on
+            if self._task is not None and self._task.get_loop() is not asyncio.get_running_loop():
+                self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((inputs, future))
+        return await future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            size = len(batch[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                size += len(request[0])
+            # Requests that were cancelled while waiting don't need their rows
+            batch = [(inputs, future) for inputs, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                outputs = await loop.run_in_executor(
+                    self.executor(), self.model.forward, np.concatenate([inputs for inputs, _ in batch])
+                )
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            self.batches += 1
+            self.rows += len(outputs)
+            start = 0
+            for inputs, future in batch:
+                if not future.done():
+                    future.set_result(outputs[start : start + len(inputs)])
+                start += len(inputs)
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        models_dir: str | None = None,
+        workers: int = min(4, os.cpu_count() or 1),
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait: float = MAX_WAIT,
+    ) -> None:
+        self.models_dir = models_dir
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.workers = workers
+        self._executor: ThreadPoolExecutor | None = None
+        self._batchers: dict[str, Batcher] = {}
+        self._loading: dict[str, asyncio.Future] = {}
+
+    def executor(self) -> ThreadPoolExecutor:
+        # Made on first use, and again after close(), so the app can start again in the same process (e.g. a second TestClient)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        return self._executor
+
+    def loaded(self) -> list[str]:
+        return sorted(self._batchers)
+
+    async def predict(self, name: str, inputs: np.ndarray) -> np.ndarray:
+        # inputs has one row of INPUT_SIZE numbers per image, the result has one row of CLASSES probabilities per image
+        batcher = self._batchers.get(name)
+        if batcher is None:
+            batcher = await self._load(name)
+        return await batcher.predict(inputs)
+
+    async def _load(self, name: str) -> Batcher:
+        # Concurrent first requests for a model wait for the same load instead of each building the model
+        loading = self._loading.get(name)
+        if loading is None:
+            loading = self._loading[name] = asyncio.ensure_future(
+                asyncio.get_running_loop().run_in_executor(self.executor(), self._build, name)
+            )
+        try:
+            model = await asyncio.shield(loading)
+        finally:
+            if loading.done():
+                self._loading.pop(name, None)
+        batcher = self._batchers.get(name)
+        if batcher is None:
+            batcher = self._batchers[name] = Batcher(model, self.executor, self.max_batch_size, self.max_wait)
+        return batcher
+
+    def _build(self, name: str) -> MLP:
+        model = BUILDERS[name](np.random.default_rng(sum(name.encode())))
+        if self.models_dir:
+            path = os.path.join(self.models_dir, f"{name}.npz")
+            if os.path.exists(path):
+                model.load(path)
+        return model
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
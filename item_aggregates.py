@@ -0,0 +1,79 @@
+# Catalog wide price statistics for GET /items/aggregates in main.py, without reading every item on each request
+# The statistics are kept up to date as items are written (it's an ItemStore listener): a write takes the old version
+# of the item out of the numbers and puts the new one in, so a PUT that changes a price moves it to its new bucket
+
+# Items are split like create_item does it: "with_tax" when item.tax is set (and not 0), "without_tax" otherwise, and "all"
+# Each group has the count, the sum and mean of the prices, the min and max price, and a histogram of the prices in fixed buckets
+# The "all" and "with_tax" groups also have the sum and mean of price + tax, the price_with_tax create_item returns
+# The min and max come from a sorted list of the prices (like ItemStore's price index), so reading any of it costs the same at any catalog size
+# The sums are exact: every float is an integer times a power of 2 no smaller than 2**-1074, so it's kept as an int counting 2**-1074s
+# and taking a price out cancels it exactly. With float += and -=, adding 1e17 and 3 and then replacing 1e17 with 1 would leave 1.0 instead of 4.0
+
+from bisect import bisect_left, insort
+from typing import Any
+
+BUCKETS = (0, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000) # upper bounds of the histogram buckets, the last bucket has the rest
+UNIT = 1 << 1074 # exact sums count 2**-1074s, the smallest step between floats
+
+
+def exact(value: float) -> int:
+    numerator, denominator = value.as_integer_ratio() # the denominator is a power of 2
+    return numerator * (UNIT // denominator)
+
+
+class PriceGroup:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.count = 0
+        self.price_sum = 0 # exact, see exact()
+        self.price_with_tax_sum = 0
+        self.histogram = [0] * (len(buckets) + 1)
+        self._prices: list[float] = []
+
+    def add(self, item: Any, sign: int) -> None:
+        # sign is 1 to add the item, -1 to take it out
+        self.count += sign
+        price = exact(item.price)
+        self.price_sum += sign * price
+        self.price_with_tax_sum += sign * (price + exact(item.tax or 0.0))
+        self.histogram[bisect_left(self.buckets, item.price)] += sign
+        if sign > 0:
+            insort(self._prices, item.price)
+        else:
+            del self._prices[bisect_left(self._prices, item.price)]
+
+    def stats(self, with_tax: bool) -> dict:
+        result = {
+            "count": self.count,
+            "price_sum": self.price_sum / UNIT, # int / int rounds the exact result once
+            "price_mean": self.price_sum / (self.count * UNIT) if self.count else None,
+            "price_min": self._prices[0] if self._prices else None,
+            "price_max": self._prices[-1] if self._prices else None,
+        }
+        if with_tax:
+            result["price_with_tax_sum"] = self.price_with_tax_sum / UNIT
+            result["price_with_tax_mean"] = self.price_with_tax_sum / (self.count * UNIT) if self.count else None
+        bounds = (None,) + self.buckets
+        result["histogram"] = [
+            {"above": bounds[index], "up_to": self.buckets[index] if index < len(self.buckets) else None, "count": count}
+            for index, count in enumerate(self.histogram)
+        ]
+        return result
+
+
+class PriceAggregates:
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS) -> None:
+        self.groups = {name: PriceGroup(buckets) for name in ("all", "with_tax", "without_tax")}
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener
+        if old_item is not None:
+            self._add(old_item, -1)
+        self._add(new_item, 1)
+
+    def _add(self, item: Any, sign: int) -> None:
+        self.groups["all"].add(item, sign)
+        self.groups["with_tax" if item.tax else "without_tax"].add(item, sign)
+
+    def stats(self) -> dict:
+        return {name: group.stats(with_tax=name != "without_tax") for name, group in self.groups.items()}
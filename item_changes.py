@@ -0,0 +1,151 @@
+# A feed of item changes, so clients can be told when an item changes instead of polling GET /items/ and GET /items/{item_id}
+# main.py serves it as server-sent events (SSE) at GET /items/changes, a browser reads it with new EventSource("/items/changes")
+
+# Every create_item and update_item write (the feed is an ItemStore listener) becomes an event with a sequence number:
+#   id: 3f9a01c2-42
+#   event: created (or updated)
+#   data: {"seq":42,"item_id":7,"item":{"name":...}}
+# The id is the feed's epoch, a random value picked when the process starts, and the sequence number. The numbers start over
+# when the server restarts, and every worker (uvicorn --workers N) has its own, so the epoch tells which feed a number came from
+# ?item_id=7&item_id=8 only sends the events of those items
+# The last `history` events are kept, so a client that reconnects with the Last-Event-ID header (EventSource does that by itself)
+# or ?since=3f9a01c2-42 gets the events it missed first. If they're older than the history, or the id is from another epoch,
+# it gets a "reset" event and should reload the items. The reset event has an id of this epoch, so the next reconnect resumes from it
+# ?since=42 without an epoch is taken as a number of this feed, a client that may see a restart should send the whole id
+
+# Every subscriber has a buffer of at most `buffer` events. A client that reads slower than items are written fills it,
+# and then it gets a "dropped" event and its stream ends, instead of the buffer growing forever. It can reconnect and resume from there
+
+import asyncio
+import os
+from collections import deque
+from typing import Any, AsyncIterator
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+EVENT_STREAM = "text/event-stream"
+KEEPALIVE = 15.0 # seconds between comments sent on a quiet stream, so proxies don't close it
+
+
+class Subscriber:
+    def __init__(self, item_ids: set[int] | None, buffer: int) -> None:
+        self.item_ids = item_ids
+        self.buffer = buffer
+        self.events: deque[tuple[int, bytes]] = deque()
+        self.dropped = False
+        self.ready = asyncio.Event()
+
+    def push(self, item_id: int, seq: int, event: bytes) -> None:
+        if self.dropped or (self.item_ids is not None and item_id not in self.item_ids):
+            return
+        if len(self.events) >= self.buffer:
+            self.dropped = True
+            self.events.clear()
+        else:
+            self.events.append((seq, event))
+        self.ready.set()
+
+
+class ChangeFeed:
+    def __init__(self, history: int = 1024, buffer: int = 256) -> None:
+        self.buffer = buffer
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.dropped = 0 # subscribers dropped for reading too slowly
+        self._history: deque[tuple[int, int, bytes]] = deque(maxlen=history) # (seq, item_id, event)
+        self._subscribers: set[Subscriber] = set()
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener
+        self.seq += 1
+        kind = "created" if old_item is None else "updated"
+        data = b'{"seq":%d,"item_id":%d,"item":%s}' % (self.seq, item_id, new_item.__pydantic_serializer__.to_json(new_item))
+        event = b"id: %s\nevent: %s\ndata: %s\n\n" % (self.event_id(self.seq), kind.encode(), data)
+        self._history.append((self.seq, item_id, event))
+        for subscriber in self._subscribers:
+            subscriber.push(item_id, self.seq, event)
+
+    def event_id(self, seq: int) -> bytes:
+        return b"%s-%d" % (self.epoch.encode(), seq)
+
+    def reset_event(self) -> bytes:
+        return b'id: %s\nevent: reset\ndata: {"seq":%d}\n\n' % (self.event_id(self.seq), self.seq)
+
+    def parse_since(self, since: str) -> int | None:
+        # The sequence number to resume after, or None when since is from another epoch (or isn't an event id at all)
+        epoch, _, seq = since.rpartition("-")
+        if not seq.isdecimal() or epoch not in ("", self.epoch):
+            return None
+        return int(seq)
+
+    async def events(
+        self,
+        request: Request,
+        item_ids: set[int] | None = None,
+        since: str | None = None,
+        limit: int | None = None,
+    ) -> AsyncIterator[bytes]:
+        subscriber = Subscriber(item_ids, self.buffer)
+        self._subscribers.add(subscriber) # before reading the history, so no event falls in between
+        sent = 0
+        try:
+            last = self.seq
+            resume = self.parse_since(since) if since is not None else None
+            if since is not None and (resume is None or resume > self.seq):
+                # An id this feed never gave out, e.g. from before the server restarted or from another worker
+                yield self.reset_event()
+            elif resume is not None and resume < self.seq:
+                oldest = self._history[0][0] if self._history else self.seq + 1
+                if resume + 1 < oldest:
+                    yield self.reset_event()
+                else:
+                    history, last = list(self._history), self.seq # later events are in the subscriber's buffer
+                    for seq, item_id, event in history:
+                        if seq > resume and (item_ids is None or item_id in item_ids):
+                            yield event
+                            sent += 1
+                            if limit is not None and sent >= limit:
+                                return
+            while True:
+                while subscriber.events:
+                    seq, event = subscriber.events.popleft()
+                    if seq <= last:
+                        continue # already sent from the history
+                    yield event
+                    last = seq
+                    sent += 1
+                    if limit is not None and sent >= limit:
+                        return
+                if subscriber.dropped:
+                    self.dropped += 1
+                    yield b'event: dropped\ndata: {"seq":%d}\n\n' % last
+                    return
+                subscriber.ready.clear()
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield b": keepalive\n\n"
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def response(self, request: Request, **options: Any) -> StreamingResponse:
+        last_event_id = request.headers.get("last-event-id")
+        if options.get("since") is None and last_event_id:
+            options["since"] = last_event_id
+        return StreamingResponse(
+            self.events(request, **options),
+            media_type=EVENT_STREAM,
+            headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "epoch": self.epoch,
+            "seq": self.seq,
+            "subscribers": len(self._subscribers),
+            "buffered": sum(len(subscriber.events) for subscriber in self._subscribers),
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,126 @@
+# Keeps the items of the ItemStore in a SQLite file, so they are still there after a restart
+# Turned on in main.py with ITEMS_DB=path/to/items.db
+
+# sqlite3 calls block, so none of them run on the event loop:
+# Reads go to a small pool of threads, each with its own connection (a SQLite connection shouldn't be used by 2 threads at once)
+# Writes go to one writer thread with its own connection. SQLite only lets one connection write at a time anyway
+# The database is in WAL mode, so the readers keep reading while the writer commits
+
+# Every commit waits for the data to be on disk (an fsync), which takes about the same time for 1 row or 1000
+# So writes aren't committed one by one: a write is queued, and everything queued within group_window (a couple of milliseconds)
+# is committed together in one transaction. Under load more writes land in every transaction, instead of every request waiting for its own fsync
+# create_item and update_item wait for sync() before answering, so a write the client got a response for is on disk
+
+# The SQL statements are always the same strings, and sqlite3 keeps the compiled (prepared) statement of every string in a per connection cache,
+# so each statement is only parsed once per connection
+
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+logger = logging.getLogger("item_database")
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+UPSERT = "INSERT INTO items (id, data) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET data = excluded.data"
+SELECT_ALL = "SELECT id, data FROM items ORDER BY id"
+SELECT_ONE = "SELECT data FROM items WHERE id = ?"
+
+
+class ItemDatabase:
+    def __init__(self, path: str, model: Any, readers: int = 4, group_window: float = 0.002) -> None:
+        self.path = path
+        self.model = model
+        self.group_window = group_window
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="item-db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="item-db-write")
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._pending: dict[int, bytes] = {} # item_id -> JSON, a second write of the same item in a group replaces the first
+        self._pending_done: asyncio.Future | None = None # resolved when the pending writes are committed
+        self._committing: asyncio.Future | None = None
+        self._flusher: asyncio.Task | None = None
+        with self._connect() as db:
+            db.execute(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False, cached_statements=32)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL") # a commit is on disk when it returns
+        with self._connections_lock:
+            self._connections.append(db)
+        return db
+
+    def _connection(self) -> sqlite3.Connection:
+        # The connection of the current pool thread
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    async def _read(self, query: str, params: tuple = ()) -> list[tuple]:
+        def run() -> list[tuple]:
+            return self._connection().execute(query, params).fetchall()
+
+        return await asyncio.get_running_loop().run_in_executor(self._readers, run)
+
+    async def load(self) -> list[tuple[int, Any]]:
+        # All the saved items as (item_id, item), to put them back in the ItemStore when the app starts
+        rows = await self._read(SELECT_ALL)
+        return [(item_id, self.model.model_validate_json(data)) for item_id, data in rows]
+
+    async def get(self, item_id: int) -> Any | None:
+        rows = await self._read(SELECT_ONE, (item_id,))
+        return self.model.model_validate_json(rows[0][0]) if rows else None
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener, queues the write for the next group commit
+        self._pending[item_id] = new_item.__pydantic_serializer__.to_json(new_item)
+        loop = asyncio.get_running_loop()
+        if self._pending_done is None:
+            self._pending_done = loop.create_future()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush())
+
+    async def sync(self) -> None:
+        # Waits until every write queued so far is committed, raises if its commit failed
+        done = self._pending_done or self._committing
+        if done is not None:
+            await asyncio.shield(done)
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            await asyncio.sleep(self.group_window) # lets the writes of concurrent requests join this group
+            rows, done = list(self._pending.items()), self._pending_done
+            self._pending, self._pending_done = {}, None
+            self._committing = done
+            try:
+                await loop.run_in_executor(self._writer, self._write, rows)
+            except Exception as error:
+                logger.exception("committing %d items failed", len(rows))
+                done.set_exception(error)
+                done.exception() # the waiting requests get the error, it isn't logged again if there are none
+            else:
+                done.set_result(None)
+            finally:
+                if self._committing is done:
+                    self._committing = None
+
+    def _write(self, rows: list[tuple[int, bytes]]) -> None:
+        db = self._connection()
+        with db: # one transaction, committed (or rolled back) at the end of the block
+            db.executemany(UPSERT, ((item_id, data.decode()) for item_id, data in rows))
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            await self._flusher
+        self._readers.shutdown()
+        self._writer.shutdown()
+        with self._connections_lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
@@ -0,0 +1,240 @@
+# Keeps the items of the ItemStore in an append-only journal, so they survive a restart without a database
+# Turned on in main.py with ITEMS_JOURNAL=path/to/directory
+
+# Every write of an item is appended to the journal as one record:
+#   length (4 bytes) | CRC32 of the payload (4 bytes) | payload: item_id (8 bytes) + the item as JSON
+# The length says where the next record starts, and the CRC tells a complete record from one that was cut off by a crash
+# Appending is cheap, the slow part is the fsync that makes sure the data is on disk. Writes queued within fsync_interval
+# are written and fsynced together (group commit), and create_item and update_item wait for sync() before answering
+
+# Replaying every write since the beginning would make startup slower and slower, so the journal is split in segments
+# (journal-000001.log, journal-000002.log, ...). Once the segments after the newest snapshot have snapshot_every records, writes go
+# to a new segment and a snapshot of all the current items is written in the background (snapshot-000001.snap, in the same record
+# format, one record per item). Then the segments and snapshots it replaces are deleted
+# Every start opens a new segment, so the records replayed at startup count toward snapshot_every too, and when there are already
+# that many the snapshot is written right there. Segments without a record are deleted. So starting up takes time for the items
+# there are plus at most snapshot_every records, not for the whole history or the number of restarts
+
+# If the app crashed in the middle of a write, the last record of the last segment is incomplete or fails its CRC
+# The journal is cut back to the end of the last good record when it's loaded
+# A write that fails (e.g. the disk is full) can leave part of a record too. Its segment is cut back if possible and the next
+# writes go to a new segment, so they never land after a bad record, where loading would cut them off. Loading cuts back
+# the end of any segment for that reason
+
+import asyncio
+import fcntl
+import logging
+import os
+import re
+import struct
+import zlib
+from typing import Any, Callable, Iterable, Iterator
+
+logger = logging.getLogger("item_journal")
+
+RECORD_HEADER = struct.Struct("<II") # payload length, CRC32 of the payload
+ITEM_ID = struct.Struct("<Q")
+SEGMENT = re.compile(r"^journal-(\d+)\.log$")
+SNAPSHOT = re.compile(r"^snapshot-(\d+)\.snap$")
+MAX_RECORD_SIZE = 16 * 1024 * 1024 # a bigger length can only come from a damaged record
+
+
+def encode_record(item_id: int, data: bytes) -> bytes:
+    payload = ITEM_ID.pack(item_id) + data
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: str) -> tuple[list[tuple[int, bytes]], int]:
+    # The (item_id, JSON) records of a file, and the offset where the good records end
+    with open(path, "rb") as file:
+        content = file.read()
+    records = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(content):
+        length, crc = RECORD_HEADER.unpack_from(content, offset)
+        start = offset + RECORD_HEADER.size
+        payload = content[start : start + length]
+        if length < ITEM_ID.size or length > MAX_RECORD_SIZE or len(payload) != length or zlib.crc32(payload) != crc:
+            break
+        records.append((ITEM_ID.unpack_from(payload)[0], payload[ITEM_ID.size :]))
+        offset = start + length
+    return records, offset
+
+
+class ItemJournal:
+    def __init__(
+        self,
+        directory: str,
+        model: Any,
+        items: Callable[[], Iterable[tuple[int, Any]]],
+        fsync_interval: float = 0.005,
+        snapshot_every: int = 100_000,
+    ) -> None:
+        # items returns all the current (item_id, item) pairs, it's what a snapshot writes (e.g. ItemStore.items)
+        self.directory = directory
+        self.model = model
+        self.items = items
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "lock"), "wb")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise RuntimeError(f"another process is using the journal in {directory}")
+        self._segment: Any = None # the open segment file
+        self._segment_number = 0
+        self._unsnapshotted = 0 # records in the segments after the newest snapshot
+        self._pending: list[bytes] = []
+        self._pending_done: asyncio.Future | None = None
+        self._committing: asyncio.Future | None = None
+        self._flusher: asyncio.Task | None = None
+        self._snapshot: asyncio.Task | None = None
+
+    def _files(self, pattern: re.Pattern) -> list[tuple[int, str]]:
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), os.path.join(self.directory, name)))
+        return sorted(found)
+
+    async def load(self) -> list[tuple[int, Any]]:
+        # All the saved items as (item_id, item), and opens a new segment for the writes from now on
+        return await asyncio.to_thread(self._load)
+
+    def _load(self) -> list[tuple[int, Any]]:
+        latest: dict[int, bytes] = {}
+        snapshots = self._files(SNAPSHOT)
+        snapshot_number = 0
+        if snapshots:
+            snapshot_number, path = snapshots[-1]
+            records, end = read_records(path)
+            if end != os.path.getsize(path):
+                raise RuntimeError(f"{path} is damaged at byte {end}")
+            latest.update(records)
+        segments = [(number, path) for number, path in self._files(SEGMENT) if number > snapshot_number]
+        replayed = 0
+        for number, path in segments:
+            records, end = read_records(path)
+            latest.update(records) # a later write of an item replaces the earlier one
+            replayed += len(records)
+            if end != os.path.getsize(path):
+                logger.warning("cutting %s back to %d bytes, the last record was incomplete", path, end)
+                with open(path, "r+b") as file:
+                    file.truncate(end)
+                    os.fsync(file.fileno())
+            if not records:
+                os.remove(path) # e.g. the segment of a run that wrote nothing
+        last = max([snapshot_number] + [number for number, _ in segments])
+        if replayed >= self.snapshot_every:
+            # Already enough to replay, so the next start gets a snapshot instead, whatever happens before the next one
+            self._write_snapshot(last, (encode_record(item_id, data) for item_id, data in sorted(latest.items())))
+            replayed = 0
+        self._open_segment(last + 1)
+        self._unsnapshotted = replayed
+        return [(item_id, self.model.model_validate_json(data)) for item_id, data in sorted(latest.items())]
+
+    def _open_segment(self, number: int) -> None:
+        if self._segment is not None:
+            self._segment.close()
+        self._segment = open(os.path.join(self.directory, f"journal-{number:06d}.log"), "ab")
+        self._segment_number = number
+        self._fsync_directory() # so the new file itself is still there after a crash
+
+    def _fsync_directory(self) -> None:
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener, queues the record for the next group commit
+        self._pending.append(encode_record(item_id, new_item.__pydantic_serializer__.to_json(new_item)))
+        loop = asyncio.get_running_loop()
+        if self._pending_done is None:
+            self._pending_done = loop.create_future()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush())
+
+    async def sync(self) -> None:
+        # Waits until every write queued so far is fsynced, raises if that failed
+        done = self._pending_done or self._committing
+        if done is not None:
+            await asyncio.shield(done)
+
+    async def _flush(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.fsync_interval) # lets the writes of concurrent requests join this group
+            records, done = self._pending, self._pending_done
+            self._pending, self._pending_done = [], None
+            self._committing = done
+            try:
+                await asyncio.to_thread(self._append, records)
+            except Exception as error:
+                logger.exception("writing %d records to the journal failed", len(records))
+                done.set_exception(error)
+                done.exception() # the waiting requests get the error, it isn't logged again if there are none
+            else:
+                done.set_result(None)
+            finally:
+                if self._committing is done:
+                    self._committing = None
+            if self._unsnapshotted >= self.snapshot_every and (self._snapshot is None or self._snapshot.done()):
+                self._start_snapshot()
+
+    def _append(self, records: list[bytes]) -> None:
+        start = self._segment.tell()
+        try:
+            self._segment.write(b"".join(records))
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+        except Exception:
+            # Part of the records may be in the file. Cut it back if that works, and go on in a new segment either way
+            try:
+                self._segment.truncate(start)
+            except OSError:
+                pass
+            self._open_segment(self._segment_number + 1)
+            raise
+        self._unsnapshotted += len(records)
+
+    def _start_snapshot(self) -> None:
+        # Runs on the event loop between group commits, so the items list and the segment switch see the same writes
+        number = self._segment_number
+        self._open_segment(number + 1)
+        self._unsnapshotted = 0
+        items = list(self.items())
+        chunks = self._snapshot_chunks(items)
+        self._snapshot = asyncio.get_running_loop().create_task(asyncio.to_thread(self._write_snapshot, number, chunks))
+
+    def _write_snapshot(self, number: int, chunks: Iterable[bytes]) -> None:
+        # The records are all the items up to the end of segment `number`, so that segment and the older ones aren't needed anymore
+        path = os.path.join(self.directory, f"snapshot-{number:06d}.snap")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path) # a crash leaves the old snapshot or the new one, never half of one
+        self._fsync_directory()
+        for old_number, old_path in self._files(SEGMENT) + self._files(SNAPSHOT):
+            if old_number < number or (old_number == number and old_path != path):
+                os.remove(old_path)
+
+    def _snapshot_chunks(self, items: list[tuple[int, Any]], size: int = 1000) -> Iterator[bytes]:
+        for start in range(0, len(items), size):
+            yield b"".join(
+                encode_record(item_id, item.__pydantic_serializer__.to_json(item)) for item_id, item in items[start : start + size]
+            )
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            await self._flusher
+        if self._snapshot is not None:
+            await self._snapshot
+        if self._segment is not None:
+            self._segment.close()
+        self._lock_file.close()
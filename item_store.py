@@ -0,0 +1,198 @@
+# An in-memory item store shared by the item path operations in main.py
+# It replaces the plain fake_items_db list so that lookups and pages don't have to walk every item
+
+# The store keeps 3 structures:
+# A dict from item_id to the item, which is the primary key hash index. Getting one item is O(1)
+# A sorted list of item ids, used for paging in id order
+# Sorted lists of (name, item_id) and (price, item_id) tuples, which are the secondary indexes
+# The item_id is part of every secondary key so that items with the same name or price still have a stable order
+
+# Paging works 2 ways:
+# skip/limit, like fake_items_db[skip : skip + limit] in the tutorial. Indexing a Python list is O(1) so a deep skip doesn't scan
+# Cursors (keyset pagination). The cursor remembers the sort key of the last item on the page, and the next page
+# starts right after it with a binary search. Page N costs the same as page 1, and items inserted while a client
+# is paging don't shift the pages it hasn't read yet like they do with skip
+
+# Other parts of the app can follow the writes with add_listener, e.g. to drop cached responses of a changed item
+# A listener is called as listener(item_id, old_item, new_item) after every put, old_item is None for a new item
+
+import base64
+import json
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from operator import itemgetter
+from typing import Any, Callable, Iterator, MutableMapping
+
+SORT_FIELDS = ("id", "name", "price")
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(sort: str, key: Any, item_id: int) -> str:
+    raw = json.dumps([sort, key, item_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple[Any, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, key, item_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("cursor is not valid")
+    if cursor_sort != sort or not isinstance(item_id, int):
+        # A cursor only makes sense for the ordering it was created with
+        raise InvalidCursor(f"cursor was not created for sort={sort}")
+    if (sort == "name" and not isinstance(key, str)) or (
+        sort == "price" and not isinstance(key, (int, float))
+    ):
+        raise InvalidCursor("cursor is not valid")
+    return key, item_id
+
+
+class ItemStore:
+    def __init__(self, records: MutableMapping[int, Any] | None = None) -> None:
+        # records is where the items themselves are kept, a dict by default. item_columns.ItemColumns keeps them in less memory
+        self._items: MutableMapping[int, Any] = records if records is not None else {}
+        self._ids: list[int] = []
+        self._by_name: list[tuple[str, int]] = []
+        self._by_price: list[tuple[float, int]] = []
+        self._next_id = 1
+        self._listeners: list[Callable[[int, Any | None, Any], None]] = []
+
+    def add_listener(self, listener: Callable[[int, Any | None, Any], None]) -> None:
+        self._listeners.append(listener)
+
+    def __len__(self) -> int:
+        return len(self._ids) # the records mapping may count items this store hasn't indexed, e.g. shared_items.SharedRecords
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._items
+
+    def get(self, item_id: int) -> Any | None:
+        return self._items.get(item_id)
+
+    def next_id(self) -> int:
+        item_id = self._next_id
+        self._next_id += 1
+        return item_id
+
+    def insert(self, item: Any) -> int:
+        # Used by create_item, the store picks the id
+        item_id = self.next_id()
+        self.put(item_id, item)
+        return item_id
+
+    def put(self, item_id: int, item: Any) -> Any | None:
+        # Used by update_item, PUT creates the item if the id isn't taken yet
+        # Returns the item that was replaced so callers can see what changed
+        old = self._items.get(item_id)
+        if old is None:
+            if self._ids and item_id < self._ids[-1]:
+                insort(self._ids, item_id)
+            else:
+                self._ids.append(item_id)
+        else:
+            self._remove_sorted(self._by_name, (old.name, item_id))
+            self._remove_sorted(self._by_price, (old.price, item_id))
+        self._items[item_id] = item
+        insort(self._by_name, (item.name, item_id))
+        insort(self._by_price, (item.price, item_id))
+        if item_id >= self._next_id:
+            self._next_id = item_id + 1
+        for listener in self._listeners:
+            listener(item_id, old, item)
+        return old
+
+    def items(self) -> Iterator[tuple[int, Any]]:
+        for item_id in self._ids:
+            yield item_id, self._items[item_id]
+
+    def page(
+        self,
+        sort: str = "id",
+        skip: int = 0,
+        limit: int = 10,
+        cursor: str | None = None,
+        where: Any | None = None,
+    ) -> tuple[list[tuple[int, Any]], str | None]:
+        # Returns the (item_id, item) pairs on the page and the cursor for the next page
+        # The next cursor is None when there are no more items
+        # where limits the page to the item ids in it (e.g. a tag_filter.Bitmap), it's checked with `in`
+        # If it has iter_from(start_id), pages in id order read the ids from it directly instead of checking every item
+        keys = self._sort_keys(sort)
+        start = 0
+        if cursor is not None:
+            key, item_id = decode_cursor(cursor, sort)
+            start = bisect_right(keys, self._key(sort, key, item_id))
+        if where is not None:
+            return self._page_where(sort, keys, start, skip, limit, where, cursor)
+        start += skip
+        end = start + limit
+        ids = [self._id_of(sort, key) for key in keys[start:end]]
+        page = [(item_id, self._items[item_id]) for item_id in ids]
+        next_cursor = None
+        if page and end < len(keys):
+            last_id, last_item = page[-1]
+            next_cursor = encode_cursor(sort, self._sort_value(sort, last_item), last_id)
+        return page, next_cursor
+
+    def _page_where(
+        self,
+        sort: str,
+        keys: list,
+        start: int,
+        skip: int,
+        limit: int,
+        where: Any,
+        cursor: str | None,
+    ) -> tuple[list[tuple[int, Any]], str | None]:
+        if sort == "id" and hasattr(where, "iter_from"):
+            first_id = keys[start] if start < len(keys) else self._next_id
+            ids = (item_id for item_id in where.iter_from(first_id) if item_id in self._items)
+        else:
+            remaining = map(keys.__getitem__, range(start, len(keys))) # no copy of the rest of the index
+            ids = (item_id for item_id in map(self._id_of_sort(sort), remaining) if item_id in where)
+        # One more than asked for, to know if there is a next page
+        ids = list(islice(ids, skip, skip + limit + 1))
+        page = [(item_id, self._items[item_id]) for item_id in ids[:limit]]
+        next_cursor = None
+        if page and len(ids) > limit:
+            last_id, last_item = page[-1]
+            next_cursor = encode_cursor(sort, self._sort_value(sort, last_item), last_id)
+        return page, next_cursor
+
+    def _id_of_sort(self, sort: str) -> Callable[[Any], int]:
+        return (lambda key: key) if sort == "id" else itemgetter(1)
+
+    def _sort_keys(self, sort: str) -> list:
+        if sort == "id":
+            return self._ids
+        if sort == "name":
+            return self._by_name
+        if sort == "price":
+            return self._by_price
+        raise ValueError(f"sort must be one of {SORT_FIELDS}")
+
+    @staticmethod
+    def _key(sort: str, key: Any, item_id: int) -> Any:
+        if sort == "id":
+            return item_id
+        return (key, item_id)
+
+    @staticmethod
+    def _id_of(sort: str, key: Any) -> int:
+        return key if sort == "id" else key[1]
+
+    @staticmethod
+    def _sort_value(sort: str, item: Any) -> Any:
+        if sort == "id":
+            return None
+        return getattr(item, sort)
+
+    @staticmethod
+    def _remove_sorted(keys: list, key: tuple) -> None:
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
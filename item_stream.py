@@ -0,0 +1,54 @@
+# Streaming item listings for GET /items/ in main.py
+# The normal response builds the whole page as a list of dicts, then FastAPI encodes all of it before sending anything
+# With a big page that means a memory spike and a slow first byte
+
+# Here the items are sent as NDJSON (one JSON object per line) while they are read from the store
+# The store is read in small batches using its cursors, so only one batch is in memory at a time, however many items the client asked for
+# Between batches the generator checks if the client went away and stops, so no work is done for a closed connection
+
+from typing import Any, AsyncIterator
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+NDJSON = "application/x-ndjson"
+BATCH_SIZE = 500
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON in request.headers.get("accept", "")
+
+
+def item_line(item_id: int, item: Any) -> bytes:
+    # Serializes the item to JSON bytes in one go and puts the item_id in front, like {"item_id": item_id, **item.model_dump()}
+    body = item.__pydantic_serializer__.to_json(item)
+    return b'{"item_id":%d,%s\n' % (item_id, body[1:])
+
+
+async def iter_ndjson(
+    request: Request,
+    store: Any,
+    sort: str = "id",
+    skip: int = 0,
+    limit: int | None = None,
+    cursor: str | None = None,
+    where: Any | None = None,
+    batch_size: int = BATCH_SIZE,
+) -> AsyncIterator[bytes]:
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = batch_size if remaining is None else min(batch_size, remaining)
+        page, cursor = store.page(sort=sort, skip=skip, limit=size, cursor=cursor, where=where)
+        skip = 0
+        if page:
+            yield b"".join(item_line(item_id, item) for item_id, item in page)
+        if remaining is not None:
+            remaining -= len(page)
+        if cursor is None or await request.is_disconnected():
+            return
+
+
+def stream_items(request: Request, store: Any, **page_args: Any) -> StreamingResponse:
+    # Decode the cursor before the response starts, so a bad cursor is still a normal 400 error
+    store.page(sort=page_args.get("sort", "id"), limit=0, cursor=page_args.get("cursor"))
+    return StreamingResponse(iter_ndjson(request, store, **page_args), media_type=NDJSON)
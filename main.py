@@ -1,6 +1,88 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Annotated
 from fastapi import FastAPI
-
-app = FastAPI()
+from route_hooks import HookedRoute, add_route_hook
+from response_cache import ResponseCache
+from openapi_cache import OpenAPICache
+
+# The lifespan function runs its code before the yield when the app starts, and the code after the yield when it stops
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    admission.add_routes(app.routes) # so /admission lists every limited route from the start
+    if openapi_cache is not None:
+        asyncio.get_running_loop().run_in_executor(None, openapi_cache.warm) # in the background, the app doesn't wait for it
+    if radix_router is not None:
+        radix_router.build() # logs the routes that are shadowed or depend on their order
+    if shared_items is not None:
+        shared_items.sync() # the items the other workers already have
+        follow_shared_items = asyncio.create_task(shared_items.follow())
+    if item_storage is not None:
+        if shared_items is None or not len(fake_items_db): # with SHARED_ITEMS, the first worker to start loads them for everyone
+            for item_id, item in await item_storage.load():
+                item_writes.put(item_id, item) # the other listeners (search, tags, ...) index the loaded items too
+        save_item = item_storage.on_write
+        if shared_items is not None:
+            save_item = shared_items.local_writes(save_item) # only the worker that made a write saves it
+        fake_items_db.add_listener(save_item) # added after loading, so the loaded items aren't written back
+    yield
+    models.close()
+    if item_storage is not None:
+        await item_storage.close()
+    if shared_items is not None:
+        follow_shared_items.cancel()
+        shared_items.close()
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = HookedRoute # lets features like the response cache wrap every path operation, see route_hooks.py
+
+# Setting OPENAPI_CACHE_DIR keeps the /openapi.json schema in that folder, so a worker loads it instead of building it,
+# and serves /openapi.json, /docs and /redoc gzipped with an ETag. See openapi_cache.py
+openapi_cache = None
+if os.environ.get("OPENAPI_CACHE_DIR"):
+    openapi_cache = OpenAPICache(app, os.environ["OPENAPI_CACHE_DIR"])
+    openapi_cache.install()
+
+# Path operations marked with @admission.limit(...) only run that many requests at once, a few more wait in a queue,
+# and the rest get a 503 with Retry-After right away. So a burst of slow PUTs or predictions doesn't slow down cheap routes like /users/me
+# The running, queued and turned away requests of each limited route are at http://127.0.0.1:8000/admission, see admission.py
+# The hook is registered before the cache, so cache hits never wait for a slot
+from admission import AdmissionControl
+
+admission = AdmissionControl()
+add_route_hook(admission.hook)
+
+# Path operations marked with @single_flight.coalesced() run once for identical requests that arrive at the same time,
+# the other requests wait and get a copy of that response. See single_flight.py
+# It only helps a function that awaits something slow (a database, another service). A function that never awaits finishes
+# before the next request is read, so there's never a run to join. None of the GET routes below await, so none is marked
+# The hook is registered after admission control, so the waiting copies don't take a slot, and before the cache, so it merges cache misses
+from single_flight import SingleFlight
+
+single_flight = SingleFlight()
+add_route_hook(single_flight.hook)
+
+# Path operations marked with @response_cache.cached() keep their responses for a while and answer If-None-Match with 304
+# See response_cache.py
+response_cache = ResponseCache()
+add_route_hook(response_cache.hook)
+
+# Every path operation is measured: latency histograms, also split into body, validation, handler and serialization time,
+# requests in flight and payload sizes. Prometheus can read them at http://127.0.0.1:8000/metrics, see metrics.py
+# The hook is registered after the cache so a cache hit is measured too
+from metrics import Metrics
+
+app_metrics = Metrics()
+add_route_hook(app_metrics.hook)
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return app_metrics.response()
+
+@app.get("/admission", include_in_schema=False)
+async def read_admission():
+    return admission.stats()
 
 # @app.get("/items/{item_id}") # value of path parameter item_id will be passed to 
 # async def read_item(item_id: int): # this function as the argument item_id
@@ -23,6 +105,7 @@ async def read_user_me():
     return {"current user": "the current user"}
 
 @app.get("/users/{user_id}")
+@response_cache.cached()
 async def read_user(user_id: str):
     return {"user_id": user_id}
 
@@ -39,6 +122,16 @@ async def read_users2():
 
 # The first path will always be used since the path matches first
 
+# Setting the environment variable RADIX_ROUTER=1 finds the route of a request in a tree of path segments instead of trying the routes in order
+# A fixed path like /users/me then always wins over /users/{user_id}, whatever order they're declared in,
+# and finding a route doesn't get slower as routes are added. When the app starts, the routes that can never be reached
+# (like a second GET /users) and the ones that only work because of the order they're declared in are logged. See radix_router.py
+from radix_router import RadixRouter
+
+radix_router = None
+if os.environ.get("RADIX_ROUTER") == "1":
+    radix_router = RadixRouter.install(app.router)
+
 from enum import Enum
 class ModelName(str, Enum): # sub class that that inherits from str and from Enum
                             # When inheriting from str, the API docs will know that the values must be a string and will render correctly
@@ -46,17 +139,55 @@ class ModelName(str, Enum): # sub class that that inherits from str and from Enu
     resnet = "resnet"
     lenet = "lenet"
 
+# Setting the environment variable FAST_JSON=1 turns on app.state.fast_json
+# get_model, create_item and update_item then send their JSON built in one pass by pydantic instead of going through jsonable_encoder, see fast_json.py
+# The responses are the same either way, python -m benchmarks.serialization shows the difference in requests per second
+from fast_json import ModelResponses, RawJSONResponse, item_json
+
+app.state.fast_json = os.environ.get("FAST_JSON") == "1"
+model_responses = ModelResponses(ModelName) # the JSON of every ModelName member, worked out once
+
+def model_message(model_name: ModelName) -> str:
+    # The message get_model sends for each model, in both the default and the fast_json responses
+    if model_name is ModelName.alexnet: # This compares the model_name in the path parameter to the enumeration member in the ModelName
+        return "Deep Learning FTW!"
+    if model_name.value == "lenet": # You can also get the model_name in the path parameter and check the value in the enumeration member
+        return "leCNN all the images"
+    return "Have some residuals"
+
 # The value of the path parameter will be an enumeration member
 @app.get("/models/{model_name}")
+@response_cache.cached()
 async def get_model(model_name: ModelName):
-    if model_name is ModelName.alexnet: # This compares the model_name in the path parameter to the enumeration member in the ModelName
-        return {"model_name": model_name, "message": "Deep Learning FTW!"}
-    
-    if model_name.value == "lenet": # You can also get the model_name in the path parameter and check the value in the enumeration member
-        return {"model_name": model_name, "message": "leCNN all the images"}
-    
-    return {"model_name": model_name, "message": "Have some residuals"} # All the return statements return the enum mebers from your path operation, even nested in a JSON body
-                                                                        # They will then be converted to their values, like strings in this case, before returning to the client
+    if app.state.fast_json:
+        return model_responses.response(model_name, model_message(model_name))
+    return {"model_name": model_name, "message": model_message(model_name)} # The return statement returns the enum member from your path operation, even nested in a JSON body
+                                                                               # It will then be converted to its value, a string in this case, before returning to the client
+
+# The models can also be run. POST a list of 28x28 grayscale images, each flattened to 784 numbers, to /models/{model_name}/predict
+# and get back the most likely digit of each image and the probabilities of all 10 digits
+# A model is loaded the first time it's used. Requests that arrive at about the same time are merged into one batch
+# and run together in a worker thread, so the other routes keep responding while a model runs. See inference.py
+from pydantic import BaseModel, Field
+from inference import INPUT_SIZE, ModelRegistry
+import numpy as np
+
+models = ModelRegistry(models_dir=os.environ.get("MODELS_DIR"))
+
+class PredictRequest(BaseModel):
+    inputs: list[Annotated[list[float], Field(min_length=INPUT_SIZE, max_length=INPUT_SIZE)]] = Field(
+        min_length=1, max_length=256
+    )
+
+@app.post("/models/{model_name}/predict")
+@admission.limit(concurrency=8, queue=64, timeout=2.0)
+async def predict(model_name: ModelName, request: PredictRequest):
+    probabilities = await models.predict(model_name.value, np.array(request.inputs, dtype=np.float32))
+    return {
+        "model_name": model_name,
+        "labels": probabilities.argmax(axis=1).tolist(),
+        "probabilities": probabilities.tolist(),
+    }
 
 # The available values for the path parameter are predefined so the docs can show them nicely
 # Going here shows this: http://127.0.0.1:8000/docs#/default/get_model_models__model_name__get
@@ -68,13 +199,42 @@ async def get_model(model_name: ModelName):
 
 # Using an option directly from Starlette, you can declare a path parameter containing a path using /files/{file_path:path}
 # The name of this parameter would be file_path and the :path part would tell it that the parameter should match any path
+
+# The route now serves the file at file_path from the FILES_ROOT directory (./files if it isn't set), see file_server.py
+# It supports Range requests for resuming downloads, never reads a big file into memory and gives a 404 for paths that leave the root
+from file_server import FileServer
+
+file_server = FileServer(os.environ.get("FILES_ROOT", "files"))
+
 @app.get("/files/{file_path:path}")
 async def read_file(file_path: str):
-    return {"file_path": file_path}\
-    
+    return file_server.response(file_path)
+
 # When you declare other function parameters that are not part of the path parameters, they are automatically interpreted as "query" parameters.
 
-fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
+# fake_items_db used to be a plain list like [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
+# Slicing a list is fine for a tutorial, but it's now an ItemStore (see item_store.py) that create_item, update_item and the item GET routes share
+# It has a hash index on item_id, sorted indexes on name and price, and cursor pagination next to skip/limit
+from item_store import ItemStore, InvalidCursor
+# With ITEMS_COLUMNAR=1 the items are kept in typed arrays and packed string buffers instead of one Item object each,
+# which takes a fraction of the memory with millions of items. An Item is built when a route reads one. See item_columns.py
+from item_columns import ItemColumns
+# With SHARED_ITEMS=path (e.g. /dev/shm/items) all the workers of uvicorn main:app --workers N keep their items in that memory mapped file
+# The items are in the file once for all the workers, and the store reads them from it. See shared_items.py and below
+from shared_items import SharedItems, SharedItemsBusy, SharedItemsError
+
+shared_items = SharedItems(os.environ["SHARED_ITEMS"]) if os.environ.get("SHARED_ITEMS") else None
+if shared_items is not None:
+    fake_items_db = ItemStore(shared_items.records)
+else:
+    fake_items_db = ItemStore(ItemColumns() if os.environ.get("ITEMS_COLUMNAR") == "1" else None)
+
+# GET /items/{item_id} is cached, so when create_item or update_item writes an item its cached responses are dropped
+# The route takes item_id as a string, so /items/7 and /items/07 are cached apart, the cache drops both
+def invalidate_cached_item(item_id, old_item, new_item):
+    response_cache.invalidate("/items/{item_id}", item_id=item_id)
+
+fake_items_db.add_listener(invalidate_cached_item)
 
 # @app.get("/items/")
 # async def read_item(skip: int = 0, limit: int = 10):
@@ -118,6 +278,7 @@ fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"
 # You can declare multiple path parameters and query parameters at the same time. FastAPI will know inherently which is which. You also don't have to declare them in a specific order. They're detected by name.
 
 @app.get("/users/{user_id}/items/{item_id}")
+@response_cache.cached()
 async def read_user_item(
     user_id: int, item_id: str, q: str | None = None, short: bool = False
 ):
@@ -145,26 +306,120 @@ async def read_user_item(
 # if you go to http://127.0.0.1:8000/items/foo-item you will get an error
 # Since needy is required, you would just need to set that parameter in the URL like this: http://127.0.0.1:8000/items/foo-item?needy=sooooneedy
 
+# Instead of polling GET /items/ or GET /items/{item_id} to see if something changed, a client can keep GET /items/changes open
+# and get a server-sent event for every item that create_item or update_item writes. See item_changes.py
+# It's declared before /items/{item_id}, otherwise "changes" would be taken as an item_id
+from fastapi import Query, Request
+from item_changes import ChangeFeed
+
+item_changes = ChangeFeed()
+fake_items_db.add_listener(item_changes.on_write)
+
+@app.get("/items/changes")
+async def read_item_changes(
+    request: Request,
+    item_id: Annotated[list[int] | None, Query()] = None, # only these items
+    since: str | None = None, # resume after this event id, the Last-Event-ID header does the same
+    limit: Annotated[int | None, Query(ge=1)] = None, # end the stream after this many events
+):
+    return item_changes.response(request, item_ids=set(item_id) if item_id else None, since=since, limit=limit)
+
+# Price totals, means, min/max and histograms of the whole catalog, split into items with and without tax
+# They're updated on every write instead of computed from all the items, so GET /items/aggregates costs the same for 10 or 10 million items
+# Declared before /items/{item_id} too. See item_aggregates.py
+from item_aggregates import PriceAggregates
+
+item_aggregates = PriceAggregates()
+fake_items_db.add_listener(item_aggregates.on_write)
+
+@app.get("/items/aggregates")
+async def read_item_aggregates():
+    return item_aggregates.stats()
+
 # You can also define a required, default and optional query parameter at the same time
 
 @app.get("/items/{item_id}")
+@response_cache.cached()
 async def read_user_item(
     item_id: str, needy: str, skip: int = 0, limit: int | None = None
 ):
     item = {"item_id": item_id, "needy": needy, "skip": skip, "limit": limit}
+    stored = fake_items_db.get(int(item_id)) if item_id.isdecimal() else None # primary key lookup, O(1) no matter how many items there are
+    if stored is not None:
+        item.update(stored.model_dump())
     return item
 
 # needy is required, skip is an int with a default value of 0 and limit is optional and is an int
+# skip and limit only page a list of items, so they are used by GET /items/ at the bottom of this file. This route just adds the stored item when there is one
 # This demonstrates all of this: http://127.0.0.1:8000/items/foo-item?needy=sooooneedy&limit=10&skip=20
 
 # First import BaseModel from pydantic
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
+# allow_inf_nan=False rejects NaN and Infinity with a 422, they can't be sorted in the price index or written as JSON
 class Item(BaseModel):
     name: str
     description: str | None = None
-    price: float
-    tax: float | None = None
+    price: float = Field(allow_inf_nan=False)
+    tax: float | None = Field(default=None, allow_inf_nan=False)
+    tags: list[str] = [] # used to filter items with GET /items/?tag=...
+
+# The 422 for a NaN price repeats the NaN it got, and JSON has no NaN, so FastAPI's own handler would fail with a 500
+# This one sends the non-finite inputs as strings ("nan", "inf") and leaves the rest of the error as it was
+import math
+from fastapi.exceptions import RequestValidationError
+from fastapi.exception_handlers import request_validation_exception_handler
+
+@app.exception_handler(RequestValidationError)
+async def validation_error(request, error: RequestValidationError):
+    errors = [
+        {**e, "input": str(e["input"])} if isinstance(e.get("input"), float) and not math.isfinite(e["input"]) else e
+        for e in error.errors()
+    ]
+    return await request_validation_exception_handler(request, RequestValidationError(errors, body=error.body))
+
+# The store is in memory, so without this every item is gone when the app restarts
+# Setting ITEMS_DB=items.db keeps the items in that SQLite file. They're loaded into fake_items_db when the app starts,
+# and every write is saved. Writes that arrive at about the same time are committed together, see item_database.py
+from item_database import ItemDatabase
+
+# Or, without a database, ITEMS_JOURNAL=directory appends every write to a journal file in that directory and snapshots all the items
+# now and then, so starting up reads the last snapshot and the writes after it. See item_journal.py
+from item_journal import ItemJournal
+
+item_storage = None
+if os.environ.get("ITEMS_DB") and os.environ.get("ITEMS_JOURNAL"):
+    raise RuntimeError("set ITEMS_DB or ITEMS_JOURNAL, not both")
+if os.environ.get("ITEMS_DB"):
+    item_storage = ItemDatabase(os.environ["ITEMS_DB"], Item)
+elif os.environ.get("ITEMS_JOURNAL"):
+    item_storage = ItemJournal(os.environ["ITEMS_JOURNAL"], Item, fake_items_db.items)
+
+# With SHARED_ITEMS, writes go to the file first, and every worker puts the changes into the indexes of its fake_items_db
+# (and the search, tag, ... indexes that follow it) before handling a request. Each worker still has its own indexes
+# Each record has room for a fixed amount of text, so a write that doesn't fit (or an item_id past the capacity) gets a 422
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+item_writes = fake_items_db # create_item, update_item and the bulk route write through this
+if shared_items is not None:
+    shared_items.attach(fake_items_db, Item)
+    item_writes = shared_items
+    add_route_hook(shared_items.hook) # registered last, so it runs before the cache and the metrics
+
+# A worker that is a whole ring of writes behind makes the others wait, and after a second their writes get a 503
+@app.exception_handler(SharedItemsBusy)
+async def shared_items_busy(request: Request, error: SharedItemsBusy):
+    return JSONResponse({"detail": str(error)}, status_code=503, headers={"Retry-After": "1"})
+
+@app.exception_handler(SharedItemsError)
+async def shared_items_error(request: Request, error: SharedItemsError):
+    return JSONResponse({"detail": str(error)}, status_code=422)
+
+async def items_saved():
+    # Waits until the items written so far are saved, so a client only gets a response for a write that will survive a restart
+    if item_storage is not None:
+        await item_storage.sync()
 
 # @app.post("/items/")
 # async def create_item(item: Item):
@@ -189,12 +444,32 @@ class Item(BaseModel):
 
 @app.post("/items/")
 async def create_item(item: Item):
-    item_dict = item.model_dump() # docs say to use dict but VSCode says to use model_dump. Have to research what this is
+    item_id = item_writes.insert(item) # the store gives the new item its id
+    await items_saved()
+    if app.state.fast_json:
+        if item.tax:
+            return RawJSONResponse(item_json(item, item_id, price_with_tax=item.price + item.tax))
+        return RawJSONResponse(item_json(item, item_id))
+    item_dict = {"item_id": item_id, **item.model_dump()} # docs say to use dict but VSCode says to use model_dump. Have to research what this is
     if item.tax:
         price_with_tax = item.price + item.tax
         item_dict.update({"price_with_tax": price_with_tax})
     return item_dict
 
+# To load a lot of items at once, POST them to /items/bulk as NDJSON (one item per line) or as a JSON array
+# The body is read as a stream and the items are validated and stored a chunk at a time, so memory use stays the same no matter how big the upload is
+# The response counts the stored items and lists the rows that failed validation. See bulk_ingest.py
+from bulk_ingest import BulkIngest
+
+bulk_items = BulkIngest(Item, item_writes)
+
+@app.post("/items/bulk")
+@admission.limit(concurrency=2, queue=4, timeout=5.0)
+async def create_items_bulk(request: Request):
+    report = await bulk_items.run(request.stream())
+    await items_saved()
+    return report
+
 # Taken from stack overflow: Note that Pydantic models can also be converted to dictionaries using dict(model). With this approach the raw field values are returned, so sub-models will not be converted to dictionaries. Either .model_dump() or dict(model) will provide a dict of fields, but .model_dump() can take numerous other arguments—such as mode, for instance, which is useful when dealing with non-JSON serializable objects (see the relevant documentation)—as well as will recursively convert nested models into dicts.
 
 # You can declare path parameters and request body at the same time
@@ -207,8 +482,17 @@ async def create_item(item: Item):
 # You can also declare body, path and query parameters, all at the same time
 # FastAPI will recognize each of them and take the data from the correct place
 
+# A PUT mostly waits for items_saved(), which saves every write made so far with one fsync (a group commit), so the limit
+# is high: the PUTs that run at once are the most one fsync can save. With concurrency=8 every fsync saved at most 8
 @app.put("/items/{item_id}")
+@admission.limit(concurrency=128, queue=256, timeout=1.0)
 async def update_item(item_id: int, item: Item, q: str | None = None):
+    item_writes.put(item_id, item) # replaces the item, or creates it if there's no item with this id yet
+    await items_saved()
+    if app.state.fast_json:
+        if q:
+            return RawJSONResponse(item_json(item, item_id, q=q))
+        return RawJSONResponse(item_json(item, item_id))
     result = {"item_id": item_id, **item.model_dump()}
     if q:
         result.update({"q": q})
@@ -433,11 +717,136 @@ from typing import Annotated
 
 # We can also exclude a query parameter from the OpenAPI schema
 # We would just set the parameter include_in_schema of Query to False
+
+# This route also lists the items in fake_items_db, one page at a time
+# skip and limit work like fake_items_db[skip : skip + limit] did, sort picks the index to page through
+# Each response has a next_cursor. Passing it back as cursor gets the next page with a binary search instead of skipping over every earlier item
+# So http://127.0.0.1:8000/items/?sort=price&limit=50 and then http://127.0.0.1:8000/items/?sort=price&limit=50&cursor=<next_cursor>
+
+# For big listings, send the header Accept: application/x-ndjson or add stream=true to the query, like http://127.0.0.1:8000/items/?stream=true
+# The items then come back as NDJSON, one item per line, sent while they are read from the store (see item_stream.py)
+# A streamed listing has no page size cap, and without a limit it sends every item
+from typing import Literal
+from fastapi import HTTPException
+from item_stream import stream_items, wants_ndjson
+
+MAX_PAGE_SIZE = 1000
+
+def check_page_size(limit: int, hint: str = "") -> None:
+    if limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit can be at most {MAX_PAGE_SIZE}{hint}")
+
+# q searches the names and descriptions of the items, like http://127.0.0.1:8000/items/?q=amazing
+# Words can be cut short ("ama") or a bit misspelled ("amazng"), and the best matches come first, each with a score
+# The search uses an index that create_item and update_item keep up to date, so it doesn't read every item. See search_index.py
+# Search results are one page of the best matches, with limit (at most MAX_PAGE_SIZE) and the tag filters
+# They aren't in id, name or price order and can't be paged or streamed, so q with skip, cursor, sort, stream or hidden_query gets a 400
+from search_index import SearchIndex
+
+item_search = SearchIndex()
+fake_items_db.add_listener(item_search.on_write)
+
+# tag can be given several times to filter the items by their tags, like http://127.0.0.1:8000/items/?tag=red&tag=large
+# match=all (the default) keeps the items that have every tag, match=any the items that have at least one of them,
+# and exclude_tag leaves out the items that have any of those tags. Filters work with paging, streaming and q
+# Every tag has a bitmap of its items, so the filters are bitwise AND, OR and AND NOT instead of loops over the items. See tag_filter.py
+from tag_filter import TagIndex
+
+item_tags = TagIndex()
+fake_items_db.add_listener(item_tags.on_write)
+
 @app.get("/items/")
 async def read_items(
+    request: Request,
     hidden_query: Annotated[str | None, Query(include_in_schema=False)] = None,
+    skip: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    sort: Literal["id", "name", "price"] = "id",
+    cursor: str | None = None,
+    stream: bool = False,
+    q: Annotated[str | None, Query(min_length=3, max_length=50)] = None,
+    tag: Annotated[list[str] | None, Query()] = None,
+    match: Literal["all", "any"] = "all",
+    exclude_tag: Annotated[list[str] | None, Query()] = None,
 ):
+    where = item_tags.select(tag, match, exclude_tag) if tag or exclude_tag else None
+    if q:
+        unsupported = [name for name in ("skip", "cursor", "sort", "stream", "hidden_query") if name in request.query_params]
+        if wants_ndjson(request):
+            unsupported.append("Accept: application/x-ndjson")
+        if unsupported:
+            raise HTTPException(status_code=400, detail=f"q can't be combined with {', '.join(unsupported)}")
+        if limit is None:
+            limit = 10
+        check_page_size(limit)
+        hits = item_search.search(q, limit=limit, where=where)
+        return {
+            "items": [
+                {"item_id": item_id, "score": score, **fake_items_db.get(item_id).model_dump()}
+                for item_id, score in hits
+            ],
+            "next_cursor": None,
+            "q": q,
+        }
+    try:
+        if stream or wants_ndjson(request):
+            return stream_items(request, fake_items_db, sort=sort, skip=skip, limit=limit, cursor=cursor, where=where)
+        if limit is None:
+            limit = 10
+        check_page_size(limit, ", use stream=true for bigger listings")
+        page, next_cursor = fake_items_db.page(sort=sort, skip=skip, limit=limit, cursor=cursor, where=where)
+    except InvalidCursor as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    results = {
+        "items": [{"item_id": item_id, **item.model_dump()} for item_id, item in page],
+        "next_cursor": next_cursor,
+    }
     if hidden_query:
-        return {"hidden_query": hidden_query}
+        results.update({"hidden_query": hidden_query})
     else:
-        return {"hidden_query": "Not found"}
\ No newline at end of file
+        results.update({"hidden_query": "Not found"})
+    return results
+
+# A client that needs several routes for one screen (/users/me, /users/{user_id}, some /users/{user_id}/items/{item_id}, /models/{model_name})
+# can send them all to POST /batch and get all the responses back at once, paying for the network round trip once
+# The requests are passed to app directly, without HTTP, and run at the same time (at most 8 at once). See batch.py
+from batch import BatchRequest, BatchRunner
+
+batch_runner = BatchRunner(app)
+
+@app.post("/batch")
+async def run_batch(batch: BatchRequest, request: Request):
+    return await batch_runner.run(batch, request.scope)
+
+# Set PROFILE_TOKEN=some-secret and send a request with the header X-Profile: some-secret to profile that one request,
+# or set PROFILE_SAMPLE_RATE=0.01 to profile 1% of the requests. The response gets an X-Profile-Id header,
+# and http://127.0.0.1:8000/profiles/{profile_id} has its collapsed stacks, ready to make a flame graph. See profiler.py
+# The hook is registered last so the profile covers all the other hooks too
+from fastapi.responses import PlainTextResponse
+from profiler import RequestProfiler
+
+request_profiler = RequestProfiler(
+    token=os.environ.get("PROFILE_TOKEN"),
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0")),
+)
+add_route_hook(request_profiler.hook)
+
+def check_profiler_access(request: Request):
+    # The profiles are only shown to requests that have PROFILE_TOKEN in X-Profile too, and to no one when it isn't set
+    if not request_profiler.authorized(request):
+        raise HTTPException(status_code=403, detail="Profiles need PROFILE_TOKEN set and sent in the X-Profile header")
+
+@app.get("/profiles", include_in_schema=False)
+@request_profiler.not_profiled()
+async def read_profiles(request: Request):
+    check_profiler_access(request)
+    return request_profiler.summaries()
+
+@app.get("/profiles/{profile_id}", include_in_schema=False)
+@request_profiler.not_profiled()
+async def read_profile(profile_id: int, request: Request):
+    check_profiler_access(request)
+    profile = request_profiler.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found, only the last 64 are kept")
+    return PlainTextResponse(profile.collapsed())
@@ -0,0 +1,195 @@
+# Per route metrics for the app, served in the Prometheus text format at GET /metrics
+# The metrics are collected by a route hook (see route_hooks.py), so every path operation is measured without changing it
+
+# For every route (method plus path template, like PUT /items/{item_id}) it keeps:
+# A latency histogram of the whole request handling
+# A latency histogram per phase, to see where the time goes:
+#   body: reading the request body
+#   admission: waiting for a slot, on routes with @admission.limit(...) (see admission.py)
+#   validation: parsing and validating the parameters and the body (e.g. the Item of update_item), and running dependencies
+#   handler: the path operation function itself
+#   serialization: turning what the function returned into the response, jsonable_encoder and JSON encoding included
+# How many requests are being handled right now (a gauge)
+# Request and response body sizes, and a count of responses per status code
+
+# All of it is updated from the event loop thread, so plain integers and lists are enough, no locks
+# Recording a request is a few list index updates, the text format is only built when /metrics is read
+
+import time
+from bisect import bisect_left
+
+from fastapi import HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+
+from route_hooks import Handler, endpoint_timings
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PHASES = ("body", "admission", "validation", "handler", "serialization")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> list[str]:
+        lines = []
+        total = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class RouteMetrics:
+    def __init__(self) -> None:
+        self.duration = Histogram()
+        self.phases = {phase: Histogram() for phase in PHASES}
+        self.in_flight = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.statuses: dict[int, int] = {}
+
+
+def label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.routes: dict[tuple[str, str], RouteMetrics] = {}
+
+    def hook(self, route: APIRoute, handler: Handler) -> Handler:
+        has_body = route.body_field is not None
+
+        async def measured_handler(request: Request) -> Response:
+            metrics = self.routes.get((request.method, route.path))
+            if metrics is None:
+                metrics = self.routes[(request.method, route.path)] = RouteMetrics()
+            timings: dict[str, float] = {}
+            token = endpoint_timings.set(timings)
+            metrics.in_flight += 1
+            start = time.perf_counter()
+            body_read = None
+            status = 500
+            try:
+                if has_body:
+                    # Reading it here times the body on its own, FastAPI then gets the body Starlette kept on the request
+                    metrics.request_bytes += len(await request.body())
+                body_read = time.perf_counter()
+                response = await handler(request)
+                status = response.status_code
+                body = getattr(response, "body", None)
+                if body is not None:
+                    metrics.response_bytes += len(body)
+                return response
+            except HTTPException as exc:
+                status = exc.status_code
+                raise
+            except RequestValidationError:
+                status = 422
+                raise
+            finally:
+                end = time.perf_counter()
+                endpoint_timings.reset(token)
+                metrics.in_flight -= 1
+                metrics.duration.observe(end - start)
+                metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+                if body_read is not None:
+                    self._observe_phases(metrics, start, body_read, timings, end, has_body, status)
+
+        return measured_handler
+
+    @staticmethod
+    def _observe_phases(
+        metrics: RouteMetrics,
+        start: float,
+        body_read: float,
+        timings: dict[str, float],
+        end: float,
+        has_body: bool,
+        status: int,
+    ) -> None:
+        phases = metrics.phases
+        if has_body:
+            phases["body"].observe(body_read - start)
+        # Admission control waits before the parameters are validated, so the wait comes out of validation
+        wait = timings.get("admission_wait")
+        if wait is not None:
+            phases["admission"].observe(wait)
+        else:
+            wait = 0.0
+        endpoint_start = timings.get("endpoint_start")
+        if endpoint_start is None:
+            # The function never ran. With an error the parameters didn't validate (or admission turned the request away),
+            # so the rest was validation. Otherwise the response came from another hook (like a response cache hit)
+            if status >= 400:
+                phases["validation"].observe(end - body_read - wait)
+            return
+        endpoint_end = timings.get("endpoint_end", end)
+        phases["validation"].observe(endpoint_start - body_read - wait)
+        phases["handler"].observe(endpoint_end - endpoint_start)
+        phases["serialization"].observe(end - endpoint_end)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP http_request_duration_seconds Time spent handling requests.",
+            "# TYPE http_request_duration_seconds histogram",
+        ]
+        routes = sorted(self.routes.items())
+        for (method, path), metrics in routes:
+            lines += metrics.duration.lines("http_request_duration_seconds", self._labels(method, path))
+        lines += [
+            "# HELP http_request_phase_duration_seconds Time spent in each phase of handling requests.",
+            "# TYPE http_request_phase_duration_seconds histogram",
+        ]
+        for (method, path), metrics in routes:
+            for phase, histogram in metrics.phases.items():
+                if histogram.count:
+                    labels = self._labels(method, path) + f',phase="{phase}"'
+                    lines += histogram.lines("http_request_phase_duration_seconds", labels)
+        lines += [
+            "# HELP http_requests_in_flight Requests being handled right now.",
+            "# TYPE http_requests_in_flight gauge",
+        ]
+        for (method, path), metrics in routes:
+            lines.append(f"http_requests_in_flight{{{self._labels(method, path)}}} {metrics.in_flight}")
+        lines += [
+            "# HELP http_responses_total Responses sent, by status code.",
+            "# TYPE http_responses_total counter",
+        ]
+        for (method, path), metrics in routes:
+            for status, count in sorted(metrics.statuses.items()):
+                lines.append(f'http_responses_total{{{self._labels(method, path)},status="{status}"}} {count}')
+        lines += [
+            "# HELP http_request_size_bytes_total Bytes of request bodies received.",
+            "# TYPE http_request_size_bytes_total counter",
+        ]
+        for (method, path), metrics in routes:
+            lines.append(f"http_request_size_bytes_total{{{self._labels(method, path)}}} {metrics.request_bytes}")
+        lines += [
+            "# HELP http_response_size_bytes_total Bytes of response bodies sent (streamed responses aren't counted).",
+            "# TYPE http_response_size_bytes_total counter",
+        ]
+        for (method, path), metrics in routes:
+            lines.append(f"http_response_size_bytes_total{{{self._labels(method, path)}}} {metrics.response_bytes}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(method: str, path: str) -> str:
+        return f'method="{method}",route="{label_value(path)}"'
+
+    def response(self) -> Response:
+        return Response(self.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,241 @@
+# Precomputed OpenAPI schema and docs pages
+# Normally every worker builds /openapi.json from all the routes and models (Item, ModelName, ...) the first time it's asked for,
+# and /docs, /redoc and /openapi.json are sent uncompressed every time
+
+# OpenAPICache.install(app) replaces those routes. With it:
+# The schema is written to cache_dir as gzipped JSON, in a file named after a hash of the route table, the fields of the models
+# and enums the routes use, and the source of the modules they're in, so any change to the routes or models gives a new file
+# The next start (or another worker) loads that file instead of building the schema
+# warm() builds or loads everything up front, main.py runs it in a background thread when the app starts,
+# and python -m openapi_cache writes the file ahead of time, e.g. while building an image
+# The JSON and the docs pages are kept in memory already gzipped, with an ETag, so a request is a dict lookup
+# and clients that send If-None-Match get a 304
+
+import asyncio
+import gzip
+import hashlib
+import importlib.metadata
+import inspect
+import json
+import os
+import re
+import threading
+from enum import Enum
+from typing import Any, Iterator, get_args
+
+from fastapi import FastAPI, Request, Response
+from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
+from fastapi.routing import APIRoute
+from pydantic import BaseModel
+from starlette.routing import Route
+
+CACHE_DIR = ".openapi_cache"
+
+
+class Asset:
+    # A response body kept both plain and gzipped, each with its own ETag (a strong ETag is for one exact body)
+    def __init__(self, body: bytes, media_type: str) -> None:
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        self.media_type = media_type
+        self.etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.gzip_etag = '"%s"' % hashlib.blake2b(self.gzipped, digest_size=16).hexdigest()
+
+    def response(self, request: Request) -> Response:
+        gzipped = "gzip" in request.headers.get("accept-encoding", "")
+        headers = {"etag": self.gzip_etag if gzipped else self.etag, "vary": "Accept-Encoding"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if headers["etag"] in (tag.strip() for tag in if_none_match.split(",")):
+            return Response(status_code=304, headers=headers)
+        if gzipped:
+            headers["content-encoding"] = "gzip"
+            return Response(self.gzipped, media_type=self.media_type, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
+
+
+ADDRESS = re.compile(r" at 0x[0-9a-f]+") # in the repr of functions (default factories, validators), different in every process
+
+
+def schema_types(annotation: Any, found: dict[int, Any]) -> None:
+    # The models and enums an annotation uses, with the ones their fields use, into found
+    if isinstance(annotation, type) and id(annotation) not in found:
+        if issubclass(annotation, BaseModel):
+            found[id(annotation)] = annotation
+            for field in annotation.model_fields.values():
+                schema_types(field.annotation, found)
+            return
+        if issubclass(annotation, Enum):
+            found[id(annotation)] = annotation
+            return
+    for arg in get_args(annotation):
+        schema_types(arg, found)
+
+
+def params(dependant: Any) -> Iterator[Any]:
+    # The parameters of a path operation and of its dependencies
+    yield from dependant.path_params + dependant.query_params + dependant.header_params + dependant.cookie_params + dependant.body_params
+    for dependency in dependant.dependencies:
+        yield from params(dependency)
+
+
+def route_table_hash(app: FastAPI) -> str:
+    digest = hashlib.sha256()
+    for package in ("fastapi", "pydantic"):
+        digest.update(f"{package}={importlib.metadata.version(package)}\n".encode())
+    digest.update(repr((app.title, app.version, app.openapi_version, app.description)).encode())
+    sources = set()
+    types: dict[int, Any] = {}
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue # only path operations are in the schema
+        endpoint = inspect.unwrap(route.endpoint)
+        digest.update(
+            repr(
+                (
+                    type(route).__name__,
+                    route.path,
+                    sorted(route.methods),
+                    route.include_in_schema,
+                    endpoint.__module__,
+                    endpoint.__qualname__,
+                    str(inspect.signature(endpoint)),
+                )
+            ).encode()
+        )
+        source = inspect.getsourcefile(endpoint)
+        if source:
+            sources.add(source)
+        for field in params(route.dependant):
+            digest.update(ADDRESS.sub("", repr((field.name, field.field_info))).encode())
+            schema_types(field.field_info.annotation, types)
+        schema_types(route.response_model, types)
+    # The models and enums as they were built, so a constraint that comes from a constant in another module (like INPUT_SIZE)
+    # changes the key too, and the source of the modules they're in for what a repr doesn't show (docstrings, examples...)
+    for model in sorted(types.values(), key=lambda model: (model.__module__, model.__qualname__)):
+        fields = model.model_fields if issubclass(model, BaseModel) else [(member.name, member.value) for member in model]
+        digest.update(ADDRESS.sub("", repr((model.__module__, model.__qualname__, fields))).encode())
+        source = inspect.getsourcefile(model)
+        if source:
+            sources.add(source)
+    for source in sorted(sources):
+        with open(source, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()[:32]
+
+
+def schema_json(schema: dict) -> bytes:
+    # The same encoding as FastAPI's JSONResponse
+    return json.dumps(schema, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class OpenAPICache:
+    def __init__(self, app: FastAPI, cache_dir: str = CACHE_DIR) -> None:
+        self.app = app
+        self.cache_dir = cache_dir
+        self.built = False # False when the schema was loaded from cache_dir
+        self._build_openapi = app.openapi
+        self._lock = threading.Lock()
+        self._schema_body: bytes | None = None
+        self._assets: dict[tuple[str, str], Asset] = {} # (page, root_path) -> Asset
+
+    def path(self) -> str:
+        return os.path.join(self.cache_dir, f"openapi-{route_table_hash(self.app)}.json.gz")
+
+    def install(self) -> None:
+        app = self.app
+        app.openapi = self.openapi
+        pages = {app.openapi_url: "openapi", app.docs_url: "docs", app.redoc_url: "redoc"}
+        for index, route in enumerate(app.router.routes):
+            page = pages.get(getattr(route, "path", None))
+            if page is not None and isinstance(route, Route):
+                app.router.routes[index] = Route(route.path, self._endpoint(page), include_in_schema=False)
+
+    def warm(self) -> None:
+        for page in ("openapi", "docs", "redoc"):
+            self.asset(page, "")
+
+    def openapi(self) -> dict[str, Any]:
+        if self.app.openapi_schema is None:
+            self.app.openapi_schema = json.loads(self.schema_body())
+        return self.app.openapi_schema
+
+    def schema_body(self) -> bytes:
+        with self._lock:
+            if self._schema_body is None:
+                self._schema_body = self._load() or self._build()
+            return self._schema_body
+
+    def asset(self, page: str, root_path: str) -> Asset:
+        asset = self._assets.get((page, root_path))
+        if asset is None:
+            asset = self._assets[(page, root_path)] = self._make_asset(page, root_path)
+        return asset
+
+    def _endpoint(self, page: str):
+        async def endpoint(request: Request) -> Response:
+            root_path = request.scope.get("root_path", "").rstrip("/")
+            asset = self._assets.get((page, root_path))
+            if asset is None:
+                # Building the schema takes a while, so it's done in a thread instead of blocking the event loop
+                asset = await asyncio.to_thread(self.asset, page, root_path)
+            return asset.response(request)
+
+        return endpoint
+
+    def _make_asset(self, page: str, root_path: str) -> Asset:
+        app = self.app
+        if page == "openapi":
+            body = self.schema_body()
+            if root_path and app.root_path_in_servers:
+                schema = json.loads(body)
+                server_urls = {server.get("url") for server in schema.get("servers", [])}
+                if root_path not in server_urls:
+                    schema["servers"] = [{"url": root_path}] + schema.get("servers", [])
+                body = schema_json(schema)
+            return Asset(body, "application/json")
+        openapi_url = root_path + app.openapi_url
+        if page == "docs":
+            oauth2_redirect_url = app.swagger_ui_oauth2_redirect_url
+            html = get_swagger_ui_html(
+                openapi_url=openapi_url,
+                title=f"{app.title} - Swagger UI",
+                oauth2_redirect_url=root_path + oauth2_redirect_url if oauth2_redirect_url else None,
+                init_oauth=app.swagger_ui_init_oauth,
+                swagger_ui_parameters=app.swagger_ui_parameters,
+            )
+        else:
+            html = get_redoc_html(openapi_url=openapi_url, title=f"{app.title} - ReDoc")
+        return Asset(html.body, "text/html")
+
+    def _load(self) -> bytes | None:
+        try:
+            with gzip.open(self.path(), "rb") as file:
+                return file.read()
+        except (OSError, EOFError):
+            return None
+
+    def _build(self) -> bytes:
+        body = schema_json(self._build_openapi())
+        self.built = True
+        path = self.path()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as file:
+                file.write(gzip.compress(body, compresslevel=9, mtime=0))
+            os.replace(tmp, path) # other workers see the whole file or no file
+            for name in os.listdir(self.cache_dir):
+                if name.startswith("openapi-") and name.endswith(".json.gz") and name != os.path.basename(path):
+                    os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass # the schema still works, it just gets built again next time
+        return body
+
+
+if __name__ == "__main__":
+    # Build time: python -m openapi_cache writes the schema of main.app to OPENAPI_CACHE_DIR (or .openapi_cache)
+    from main import app, openapi_cache
+
+    cache = openapi_cache or OpenAPICache(app, os.environ.get("OPENAPI_CACHE_DIR", CACHE_DIR))
+    cache.warm()
+    print(f"{'built' if cache.built else 'already cached'}: {cache.path()}")
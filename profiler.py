@@ -0,0 +1,159 @@
+# Profiles single requests, to find out why one particular request was slow when it can't be reproduced offline
+# A request is profiled when it has an X-Profile header with the PROFILE_TOKEN set in main.py, or at random with a
+# probability of sample_rate (PROFILE_SAMPLE_RATE). Other requests only pay for one header lookup (and a random() when sample_rate is set)
+
+# While a profiled request runs, a background thread looks at the event loop thread's stack every `interval` seconds (a sampling profiler)
+# Samples taken while another request's code was running are left out: a sample counts when the stack goes through this request's handler
+# The samples are kept as "collapsed stacks", one line per distinct stack with how many samples had it:
+#   main.py:update_item;item_store.py:put;search_index.py:on_write 12
+# which flamegraph.pl, speedscope or inferno turn into a flame graph
+# The last `keep` profiles are kept in a ring buffer. The profiled response has an X-Profile-Id header, and main.py serves the
+# profiles at /profiles and /profiles/{profile_id}, only to requests with the token, so they can't be read at all without one
+
+import hmac
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+from types import FrameType
+from typing import Any, Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from route_hooks import Handler, route_option
+
+HEADER = "x-profile"
+OPTION = "__not_profiled__"
+
+
+class Profile:
+    def __init__(self, profile_id: int, method: str, path: str) -> None:
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.duration = 0.0
+        self.status_code: int | None = None
+        self.samples = 0
+        self.stacks: Counter[str] = Counter()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "started": self.started,
+            "duration_ms": self.duration * 1000,
+            "status_code": self.status_code,
+            "samples": self.samples,
+        }
+
+
+def frame_name(frame: FrameType) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+class RequestProfiler:
+    def __init__(self, token: str | None = None, sample_rate: float = 0.0, interval: float = 0.002, keep: int = 64) -> None:
+        self.token = token
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.profiles: deque[Profile] = deque(maxlen=keep)
+        self._ids = itertools.count(1)
+        self._active: dict[int, tuple[FrameType, Profile]] = {} # id of the handler frame -> (frame, profile)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._loop_thread = threading.get_ident()
+
+    def authorized(self, request: Request) -> bool:
+        # For the admin routes. Without a token no one can read the profiles, sampled ones (PROFILE_SAMPLE_RATE) included
+        if not self.token:
+            return False
+        return hmac.compare_digest(request.headers.get(HEADER, ""), self.token)
+
+    def _wanted(self, request: Request) -> bool:
+        if self.token:
+            header = request.headers.get(HEADER)
+            if header is not None and hmac.compare_digest(header, self.token):
+                return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def not_profiled(self) -> Callable:
+        # For the routes that read the profiles, they send the X-Profile header but shouldn't make profiles themselves
+        return route_option(OPTION)
+
+    def hook(self, route: APIRoute, handler: Handler) -> Handler:
+        if getattr(route.endpoint, OPTION, None) is not None:
+            return handler
+
+        async def profiled_handler(request: Request) -> Response:
+            if not self._wanted(request):
+                return await handler(request)
+            profile = Profile(next(self._ids), request.method, request.url.path)
+            frame = sys._getframe() # this coroutine's frame is on the stack whenever this request's code runs
+            self._start(frame, profile)
+            start = time.perf_counter()
+            try:
+                response = await handler(request)
+                profile.status_code = response.status_code
+                response.headers["x-profile-id"] = str(profile.id)
+                return response
+            finally:
+                profile.duration = time.perf_counter() - start
+                self._stop(frame, profile)
+
+        return profiled_handler
+
+    def _start(self, frame: FrameType, profile: Profile) -> None:
+        with self._lock:
+            self._loop_thread = threading.get_ident()
+            self._active[id(frame)] = (frame, profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _stop(self, frame: FrameType, profile: Profile) -> None:
+        with self._lock:
+            self._active.pop(id(frame), None)
+            self.profiles.append(profile)
+
+    def _sample(self) -> None:
+        while True:
+            self._wake.wait()
+            with self._lock:
+                if not self._active:
+                    self._wake.clear()
+                    continue
+            stack = sys._current_frames().get(self._loop_thread)
+            frames = []
+            while stack is not None:
+                frames.append(stack)
+                stack = stack.f_back
+            # frames goes from the innermost call out, a profile gets the part below its handler frame
+            with self._lock: # so a profile doesn't change after _stop() put it in the ring buffer
+                for index, frame in enumerate(frames):
+                    entry = self._active.get(id(frame))
+                    if entry is not None and entry[0] is frame:
+                        profile = entry[1]
+                        profile.samples += 1
+                        profile.stacks[";".join(frame_name(f) for f in reversed(frames[:index]))] += 1
+            del frames
+            time.sleep(self.interval)
+
+    def get(self, profile_id: int) -> Profile | None:
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def summaries(self) -> list[dict[str, Any]]:
+        return [profile.summary() for profile in reversed(self.profiles)]
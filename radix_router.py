@@ -0,0 +1,198 @@
+# A radix tree router for the app, turned on with RADIX_ROUTER=1 (see main.py)
+# Starlette finds the route of a request by trying every route's regex in the order they were declared
+# That's why /users/me has to be declared before /users/{user_id}, and why finding a route costs more the more routes there are
+
+# Here all the routes are put in a tree, one level per path segment: /users/{user_id}/items/{item_id} is
+# "users" -> {user_id} -> "items" -> {item_id}. Finding a route walks down the tree one segment at a time,
+# so it costs about the same with 10 routes or 1000, only the depth of the path matters
+# At every level a static segment is tried first, then parameters (checked with their convertor, so {item_id:int} only takes digits),
+# then {name:path} parameters, which take the rest of the path like /files/{file_path:path} does
+# So /users/me goes to read_user_me wherever it was declared
+
+# The routes found in the tree are checked with their own matches(), so the path parameters, the 405 for a wrong method,
+# and everything FastAPI puts in the request scope are the same as with Starlette's router
+# Anything the tree doesn't find (404s, trailing slash redirects, mounts, routes with a segment like {name}.txt that can't be
+# a tree level) goes to Starlette's router as before
+
+# When the tree is built it logs the routes that can never be reached (the same path and method declared twice),
+# and the routes that Starlette would have sent to a different path operation because of the order they were declared in
+
+import logging
+import re
+from typing import Any
+
+from starlette.routing import BaseRoute, Match, Route, Router
+from starlette.types import Receive, Scope, Send
+
+logger = logging.getLogger("radix_router")
+
+PARAM = re.compile(r"^{([a-zA-Z_][a-zA-Z0-9_]*)(?::([a-zA-Z_][a-zA-Z0-9_]*))?}$")
+
+
+class Node:
+    __slots__ = ("static", "params", "rest", "routes")
+
+    def __init__(self) -> None:
+        self.static: dict[str, Node] = {}
+        self.params: dict[tuple[str, str], tuple[re.Pattern, Node]] = {} # (name, convertor) -> (regex, node)
+        self.rest: list[tuple[str, re.Pattern, Node]] = [] # {name:path} parameters, (name, regex, node)
+        self.routes: list[BaseRoute] = []
+
+
+def route_path(scope: Scope) -> str:
+    # The path without the root_path, like Starlette matches it
+    path: str = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        if path == root_path:
+            return ""
+        if path[len(root_path)] == "/":
+            return path[len(root_path) :]
+    return path
+
+
+class RadixRouter:
+    def __init__(self, router: Router) -> None:
+        self.router = router
+        self.fallback = router.app # Starlette's own matching, for what the tree doesn't find
+        self.root = Node()
+        self.unsupported: list[BaseRoute] = []
+        self._built_from: list[BaseRoute] | None = None
+
+    @classmethod
+    def install(cls, router: Router) -> "RadixRouter":
+        radix = cls(router)
+        if router.middleware_stack != router.app:
+            raise RuntimeError("the radix router can't be used with router middleware")
+        router.middleware_stack = radix
+        return radix
+
+    def build(self) -> list[str]:
+        # Builds the tree from the router's routes, returns (and logs) the problems found in the route table
+        root = Node()
+        unsupported = []
+        for route in self.router.routes:
+            if not self._add(root, route):
+                unsupported.append(route)
+        self.root = root
+        self.unsupported = unsupported
+        self._built_from = list(self.router.routes)
+        problems = self.report()
+        for problem in problems:
+            logger.warning(problem)
+        return problems
+
+    def report(self) -> list[str]:
+        problems = []
+        routes = [route for route in self.router.routes if isinstance(route, Route)]
+        seen: dict[tuple[str, str], Route] = {}
+        for index, route in enumerate(routes):
+            template = re.sub(r"{[^}:]+(:[^}]+)?}", lambda m: "{%s}" % (m.group(1) or ""), route.path)
+            shadowed: dict[int, tuple[Route, list[str]]] = {}
+            for method in sorted((route.methods or set()) - {"HEAD"}):
+                first = seen.setdefault((method, template), route)
+                if first is not route:
+                    shadowed.setdefault(id(first), (first, []))[1].append(method)
+            for first, methods in shadowed.values():
+                problems.append(
+                    f"{' '.join(methods)} {route.path} ({route.name}) is shadowed by {first.path} ({first.name}), "
+                    "which has the same path and is declared first"
+                )
+            if "{" not in route.path:
+                for earlier in routes[:index]:
+                    if (
+                        "{" in earlier.path
+                        and (route.methods or set()) & (earlier.methods or set())
+                        and earlier.path_regex.match(route.path)
+                    ):
+                        problems.append(
+                            f"{route.path} ({route.name}) is declared after {earlier.path} ({earlier.name}), "
+                            "which matches it too. Starlette's router sends it to the earlier route, "
+                            "the radix router sends it to the static route"
+                        )
+        return problems
+
+    def _add(self, root: Node, route: BaseRoute) -> bool:
+        if not isinstance(route, Route) or not route.path.startswith("/"):
+            return False
+        node = root
+        segments = route.path[1:].split("/")
+        for index, segment in enumerate(segments):
+            if "{" not in segment:
+                node = node.static.setdefault(segment, Node())
+                continue
+            param = PARAM.match(segment)
+            if param is None:
+                return False # a segment mixing text and a parameter
+            name, convertor = param.group(1), param.group(2) or "str"
+            regex = route.param_convertors[name].regex
+            if convertor == "path":
+                if index != len(segments) - 1:
+                    return False # a path parameter in the middle of the path
+                for rest_name, _, rest_node in node.rest:
+                    if rest_name == name:
+                        node = rest_node
+                        break
+                else:
+                    rest_node = Node()
+                    node.rest.append((name, re.compile(regex), rest_node))
+                    node = rest_node
+                break
+            entry = node.params.get((name, convertor))
+            if entry is None:
+                entry = node.params[(name, convertor)] = (re.compile(regex), Node())
+            node = entry[1]
+        node.routes.append(route)
+        return True
+
+    def candidates(self, path: str) -> list[BaseRoute]:
+        # The routes whose path can match, most specific first
+        if not path.startswith("/"):
+            return []
+        found: list[BaseRoute] = []
+        self._walk(self.root, path[1:].split("/"), 0, found)
+        return found
+
+    def _walk(self, node: Node, segments: list[str], index: int, found: list[BaseRoute]) -> None:
+        if index == len(segments):
+            found.extend(node.routes)
+            return
+        segment = segments[index]
+        child = node.static.get(segment)
+        if child is not None:
+            self._walk(child, segments, index + 1, found)
+        if segment:
+            for regex, child in node.params.values():
+                if regex.fullmatch(segment):
+                    self._walk(child, segments, index + 1, found)
+        if node.rest:
+            rest = "/".join(segments[index:])
+            for _, regex, child in node.rest:
+                if regex.fullmatch(rest):
+                    found.extend(child.routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] not in ("http", "websocket"):
+            await self.fallback(scope, receive, send)
+            return
+        if self._built_from is None or len(self._built_from) != len(self.router.routes):
+            self.build()
+        if "router" not in scope:
+            scope["router"] = self.router
+        partial: tuple[BaseRoute, dict[str, Any]] | None = None
+        for route in self.candidates(route_path(scope)):
+            match, child_scope = route.matches(scope)
+            if match == Match.FULL:
+                scope["route"] = route
+                scope.update(child_scope)
+                await route.handle(scope, receive, send)
+                return
+            if match == Match.PARTIAL and partial is None:
+                partial = (route, child_scope)
+        if partial is not None and not self.unsupported:
+            route, child_scope = partial
+            scope["route"] = route
+            scope.update(child_scope)
+            await route.handle(scope, receive, send)
+            return
+        await self.fallback(scope, receive, send)
@@ -0,0 +1,200 @@
+# A response cache for GET path operations whose response only depends on the request
+# Turn it on for a path operation with @response_cache.cached() under the @app.get(...) line
+# The cache is a route hook (see route_hooks.py), so on a hit the parameters aren't validated, the function doesn't run and nothing is encoded
+
+# Entries are keyed on the path plus the query with its parameters sorted, so ?a=1&b=2 and ?b=2&a=1 share an entry
+# Entries expire after their ttl, and the least recently used ones are dropped when there are too many or they take too many bytes
+# Every cached response gets a strong ETag (a hash of the body). A request with a matching If-None-Match header gets
+# a 304 Not Modified with no body, straight from the cache
+# invalidate() drops the entries of a route, e.g. when update_item changes an item that GET /items/{item_id} returned
+# The entries are also indexed by route and path parameter value, so dropping the entries of one item doesn't look at the others
+# Values are normalized first: a decimal string is taken as the number it spells, so /items/7 and /items/07 are both dropped for item 7
+
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable
+from urllib.parse import parse_qsl, urlencode
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from route_hooks import Handler, route_option
+
+OPTION = "__response_cache__"
+
+
+@dataclass
+class CacheEntry:
+    route_path: str
+    path_params: dict
+    status_code: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+    etag: str
+    expires: float
+    size: int = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.size = len(self.body) + sum(len(k) + len(v) for k, v in self.headers)
+
+
+def make_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def param_value(value: Any) -> Any:
+    # How a path parameter value is indexed, "07" and 7 are the same
+    if isinstance(value, str) and value.isdecimal():
+        return int(value)
+    if isinstance(value, int):
+        return value
+    return str(value)
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"etag": etag})
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        max_bytes: int = 32 * 1024 * 1024,
+        default_ttl: float = 60.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[tuple, CacheEntry] = OrderedDict()
+        self._by_route: dict[str, set[tuple]] = {}
+        self._by_param: dict[tuple[str, str, Any], set[tuple]] = {} # (route path, parameter name, normalized value) -> keys
+        self._bytes = 0
+
+    def cached(self, ttl: float | None = None) -> Callable:
+        return route_option(OPTION, ttl=ttl)
+
+    def hook(self, route: APIRoute, handler: Handler) -> Handler:
+        options = getattr(route.endpoint, OPTION, None)
+        if options is None or "GET" not in route.methods:
+            return handler
+        ttl = options["ttl"] if options["ttl"] is not None else self.default_ttl
+
+        async def cached_handler(request: Request) -> Response:
+            if request.method != "GET":
+                return await handler(request)
+            key = self.key(route.path, request)
+            if_none_match = request.headers.get("if-none-match")
+            entry = self.get(key)
+            if entry is not None:
+                self.hits += 1
+                if etag_matches(if_none_match, entry.etag):
+                    return not_modified(entry.etag)
+                response = Response(content=entry.body, status_code=entry.status_code)
+                response.raw_headers = list(entry.headers)
+                return response
+            self.misses += 1
+            response = await handler(request)
+            body = getattr(response, "body", None)
+            if response.status_code != 200 or body is None:
+                # Errors and streamed responses aren't cached
+                return response
+            etag = make_etag(body)
+            response.headers["etag"] = etag
+            self.put(
+                key,
+                CacheEntry(
+                    route_path=route.path,
+                    path_params=dict(request.path_params),
+                    status_code=response.status_code,
+                    headers=list(response.raw_headers),
+                    body=body,
+                    etag=etag,
+                    expires=self.clock() + ttl,
+                ),
+            )
+            if etag_matches(if_none_match, etag):
+                return not_modified(etag)
+            return response
+
+        return cached_handler
+
+    @staticmethod
+    def key(route_path: str, request: Request) -> tuple:
+        query = urlencode(sorted(parse_qsl(request.url.query, keep_blank_values=True)))
+        return (route_path, request.url.path, query)
+
+    def get(self, key: tuple) -> CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= self.clock():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, entry: CacheEntry) -> None:
+        if entry.size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._by_route.setdefault(entry.route_path, set()).add(key)
+        for name, value in entry.path_params.items():
+            self._by_param.setdefault((entry.route_path, name, param_value(value)), set()).add(key)
+        self._bytes += entry.size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate(self, route_path: str, **path_params: Any) -> int:
+        # Drops the entries of route_path whose path parameters match the ones given (all of them if none are given)
+        # Returns how many entries were dropped
+        if path_params:
+            matching = [self._by_param.get((route_path, name, param_value(value)), set()) for name, value in path_params.items()]
+            keys = list(set.intersection(*matching))
+        else:
+            keys = list(self._by_route.get(route_path, ()))
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._by_route.clear()
+        self._by_param.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _remove(self, key: tuple) -> None:
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+        keys = self._by_route[entry.route_path]
+        keys.discard(key)
+        if not keys:
+            del self._by_route[entry.route_path]
+        for name, value in entry.path_params.items():
+            param = (entry.route_path, name, param_value(value))
+            keys = self._by_param[param]
+            keys.discard(key)
+            if not keys:
+                del self._by_param[param]
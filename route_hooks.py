@@ -0,0 +1,96 @@
+# Route hooks let a feature wrap the request handler of every path operation
+# FastAPI turns each path operation into an APIRoute, and the APIRoute builds a handler that
+# reads the request, validates the parameters, runs our function and encodes the response
+# A hook gets the route and that handler and returns a new handler, so it can run code before and after all of it
+# (or not call the handler at all, like the response cache does on a hit)
+
+# To use it, set app.router.route_class = HookedRoute before declaring path operations, then register hooks with add_route_hook
+# Hooks are applied the first time a route handles a request, so they can be registered after the routes too
+# The first registered hook is the innermost one, the last registered hook runs first
+
+# HookedRoute also wraps each path operation function so that hooks can tell how long the function itself took
+# If a hook sets endpoint_timings to a dict, the wrapper stores "endpoint_start" and "endpoint_end" (time.perf_counter values) in it
+# When no hook set it, the wrapper only does one ContextVar lookup
+
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+Handler = Callable[[Request], Awaitable[Response]]
+RouteHook = Callable[[APIRoute, Handler], Handler]
+
+_hooks: list[RouteHook] = []
+
+endpoint_timings: ContextVar[dict | None] = ContextVar("endpoint_timings", default=None)
+
+
+def add_route_hook(hook: RouteHook) -> RouteHook:
+    _hooks.append(hook)
+    return hook
+
+
+def route_option(name: str, **options: Any) -> Callable:
+    # Marks a path operation function so a hook can find its options with getattr(route.endpoint, name)
+    # Put it under the @app.get(...) line so the function is marked before FastAPI sees it
+    def decorator(func: Callable) -> Callable:
+        setattr(func, name, options)
+        return func
+
+    return decorator
+
+
+def timed_endpoint(func: Callable) -> Callable:
+    if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+        return func # streamed endpoints keep running after the handler returns, there's nothing useful to time
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def timed(*args: Any, **kwargs: Any) -> Any:
+            timings = endpoint_timings.get()
+            if timings is None:
+                return await func(*args, **kwargs)
+            timings["endpoint_start"] = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                timings["endpoint_end"] = time.perf_counter()
+
+    else:
+
+        @functools.wraps(func)
+        def timed(*args: Any, **kwargs: Any) -> Any:
+            timings = endpoint_timings.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            timings["endpoint_start"] = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings["endpoint_end"] = time.perf_counter()
+
+    return timed
+
+
+class HookedRoute(APIRoute):
+    def __init__(self, path: str, endpoint: Callable, **kwargs: Any) -> None:
+        # FastAPI reads the parameters through functools.wraps, so the docs and validation are the same as for func
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Handler:
+        handler = super().get_route_handler()
+        chain: Handler | None = None
+
+        async def hooked_handler(request: Request) -> Response:
+            nonlocal chain
+            if chain is None:
+                chain = handler
+                for hook in _hooks:
+                    chain = hook(self, chain)
+            return await chain(request)
+
+        return hooked_handler
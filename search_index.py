@@ -0,0 +1,185 @@
+# Text search over item names and descriptions, for the q parameter of GET /items/ in main.py
+# Scanning every item for every query gets slower as the catalog grows, so the search uses indexes that are
+# updated as items are written (it's an ItemStore listener), and a query only looks at the items that share something with it
+
+# Two indexes are kept:
+# Words: every word of an item's name and description, mapped to the items that have it. The words are also kept in a sorted list,
+#   so all the words starting with a prefix are found with a binary search ("ama" finds "amazing")
+# Trigrams: every 3 letter piece of every word ("amazing" -> "  a", " am", "ama", "maz", ...), mapped to the words that have it.
+#   A misspelled word still shares most of its trigrams with the right one, which is how fuzzy matches are found ("amazng" finds "amazing")
+
+# Every query word is matched exactly and by prefix, or fuzzily when neither finds anything, and scores less for each. Words in the name count more than
+# words in the description. An item gets the score of its best match for each query word, added up over the query words
+
+# A common word can be in most of the items, so the search doesn't score every item that has it. The items of a word are kept
+# sorted by weight (name, then description) and item_id, so each query word gives its items best first, and the search stops
+# as soon as no item it hasn't looked at can beat the `limit` best ones it has (the threshold algorithm). For one query word that's after `limit` items
+
+import heapq
+import re
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from itertools import chain
+from typing import Any, Iterator
+
+WORD = re.compile(r"\w+")
+NAME_WEIGHT = 2.0
+DESCRIPTION_WEIGHT = 1.0
+EXACT = 1.0
+PREFIX = 0.6
+MAX_PREFIX_WORDS = 50 # the most words one prefix can expand to
+MIN_SIMILARITY = 0.4 # how much of the trigrams two words must share to be a fuzzy match
+MAX_FUZZY_WORDS = 20
+
+
+def words(text: str | None) -> list[str]:
+    return WORD.findall(text.lower()) if text else []
+
+
+def trigrams(word: str) -> set[str]:
+    padded = f"  {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    def __init__(self) -> None:
+        # word -> {weight: item ids with that weight for the word, sorted}
+        self._postings: dict[str, dict[float, list[int]]] = defaultdict(dict)
+        self._sorted_words: list[str] = []
+        self._trigrams: dict[str, set[str]] = defaultdict(set)
+        self._trigram_counts: dict[str, int] = {} # word -> how many trigrams it has
+        # item_id -> its words and their weights, to score an item and to take its words out again when it changes
+        self._item_words: dict[int, dict[str, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._item_words)
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener
+        self.remove(item_id)
+        self.add(item_id, new_item.name, new_item.description)
+
+    def add(self, item_id: int, name: str, description: str | None) -> None:
+        weights: dict[str, float] = {}
+        for word in words(description):
+            weights[word] = max(weights.get(word, 0.0), DESCRIPTION_WEIGHT)
+        for word in words(name):
+            weights[word] = NAME_WEIGHT
+        for word, weight in weights.items():
+            postings = self._postings[word]
+            if not postings:
+                self._add_word(word)
+            insort(postings.setdefault(weight, []), item_id)
+        self._item_words[item_id] = weights
+
+    def remove(self, item_id: int) -> None:
+        for word, weight in self._item_words.pop(item_id, {}).items():
+            postings = self._postings[word]
+            item_ids = postings[weight]
+            index = bisect_left(item_ids, item_id)
+            if index < len(item_ids) and item_ids[index] == item_id:
+                del item_ids[index]
+            if not item_ids:
+                del postings[weight]
+            if not postings:
+                del self._postings[word]
+                self._remove_word(word)
+
+    def search(self, query: str, limit: int = 10, where: Any | None = None) -> list[tuple[int, float]]:
+        # Returns up to limit (item_id, score) pairs, best first
+        # where limits the results to the item ids in it (e.g. a tag_filter.Bitmap)
+        query_matches = [matches for matches in map(self._matches, dict.fromkeys(words(query))) if matches]
+        if not query_matches or limit <= 0:
+            return []
+        streams = [self._ranked(matches) for matches in query_matches]
+        heads = [next(stream, None) for stream in streams]
+        best: list[tuple[float, int]] = [] # min-heap of (score, -item_id) of the best items so far, the worst of them first
+        seen: set[int] = set()
+        while True:
+            live = [index for index, head in enumerate(heads) if head is not None]
+            if not live:
+                break
+            # No item that wasn't seen yet scores more than the next contribution of every query word added up,
+            # and one that scores exactly that comes after the heads in item_id order, so it loses the tie
+            threshold = sum(-heads[index][0] for index in live)
+            if len(best) >= limit:
+                score, negative_id = best[0]
+                if score > threshold or (score == threshold and -negative_id <= max(heads[index][1] for index in live)):
+                    break
+            for index in live:
+                _, item_id = heads[index]
+                heads[index] = next(streams[index], None)
+                if item_id in seen:
+                    continue
+                seen.add(item_id)
+                if where is not None and item_id not in where:
+                    continue
+                entry = (self._score(item_id, query_matches), -item_id)
+                if len(best) < limit:
+                    heapq.heappush(best, entry)
+                elif entry > best[0]:
+                    heapq.heapreplace(best, entry)
+        return [(-negative_id, score) for score, negative_id in sorted(best, reverse=True)]
+
+    def _ranked(self, matches: dict[str, float]) -> Iterator[tuple[float, int]]:
+        # The items of the words one query word matched, as (-contribution, item_id), best first
+        # An item can come more than once (it has several of the words), its first time has its best contribution
+        def word_items(word: str, match: float) -> Iterator[tuple[float, int]]:
+            postings = self._postings[word]
+            for weight in sorted(postings, reverse=True):
+                contribution = -weight * match
+                for item_id in postings[weight]:
+                    yield contribution, item_id
+
+        return heapq.merge(*(word_items(word, match) for word, match in matches.items()))
+
+    def _score(self, item_id: int, query_matches: list[dict[str, float]]) -> float:
+        item_words = self._item_words[item_id]
+        score = 0.0
+        for matches in query_matches:
+            score += max((weight * matches[word] for word, weight in item_words.items() if word in matches), default=0.0)
+        return score
+
+    def _matches(self, query_word: str) -> dict[str, float]:
+        # The indexed words that match query_word, with how well they match
+        matches: dict[str, float] = {}
+        if query_word in self._postings:
+            matches[query_word] = EXACT
+        start = bisect_left(self._sorted_words, query_word)
+        for word in self._sorted_words[start : start + MAX_PREFIX_WORDS + 1]:
+            if not word.startswith(query_word):
+                break
+            matches.setdefault(word, PREFIX * len(query_word) / len(word))
+        if not matches and len(query_word) >= 3:
+            # Only when nothing matched exactly or by prefix, so the common case doesn't pay for it
+            grams = trigrams(query_word)
+            # How many trigrams each word shares with the query word, counted in C by Counter
+            shared = Counter(chain.from_iterable(self._trigrams.get(gram, ()) for gram in grams))
+            similar = []
+            for word, count in shared.items():
+                # Jaccard similarity of the trigram sets
+                similarity = count / (len(grams) + self._trigram_counts[word] - count)
+                if similarity >= MIN_SIMILARITY:
+                    similar.append((similarity, word))
+            for similarity, word in heapq.nlargest(MAX_FUZZY_WORDS, similar):
+                matches[word] = similarity * PREFIX
+        return matches
+
+    def _add_word(self, word: str) -> None:
+        self._sorted_words.insert(bisect_left(self._sorted_words, word), word)
+        grams = trigrams(word)
+        self._trigram_counts[word] = len(grams)
+        for gram in grams:
+            self._trigrams[gram].add(word)
+
+    def _remove_word(self, word: str) -> None:
+        index = bisect_left(self._sorted_words, word)
+        if index < len(self._sorted_words) and self._sorted_words[index] == word:
+            del self._sorted_words[index]
+        del self._trigram_counts[word]
+        for gram in trigrams(word):
+            words_with_gram = self._trigrams.get(gram)
+            if words_with_gram is not None:
+                words_with_gram.discard(word)
+                if not words_with_gram:
+                    del self._trigrams[gram]
@@ -0,0 +1,428 @@
+# Items shared by all the worker processes of the app, e.g. when it runs with uvicorn main:app --workers 4
+# Every worker is its own process with its own fake_items_db, so an item created in one worker isn't seen by the others
+# Turned on in main.py with SHARED_ITEMS=path, e.g. SHARED_ITEMS=/dev/shm/items so the file lives in memory
+
+# The file is mapped into every worker with mmap, so all of them read and write the same memory
+# Its layout is fixed, so a worker finds an item with arithmetic instead of parsing anything:
+#   a header: a magic number, the sizes below, the next free item_id and the number of writes so far (the version)
+#   one slot per worker: its pid and the last version it has synced
+#   a ring with the last RING_SIZE writes: write number v is in ring[v % RING_SIZE], as the item_id and a copy of its record from before the write
+#   one record of RECORD_SIZE bytes per item_id, for item_id 1 to capacity. A record has price and tax as doubles
+#   and name, description and tags (as JSON) as UTF-8 in fixed size areas, so an item whose fields are longer doesn't fit
+# The file is sparse, only the pages of records that were written take memory
+
+# The items are only kept in the file. SharedRecords is the records mapping of the worker's ItemStore (like
+# item_columns.ItemColumns, see item_store.py), it builds an Item from the record when a route reads one
+# What each worker still keeps is what its indexes need: the store's sorted ids, names and prices, and the search, tag and
+# price indexes that other features keep from the store's listeners
+
+# Writes take an flock on the file, so one worker writes at a time and item ids are never given out twice
+# Readers don't lock: every record starts with a counter that is odd while the record is being written (a seqlock),
+# so a reader that saw it change just reads the record again. A worker killed while writing leaves its record odd,
+# so after SPINS tries a reader takes the lock, and a record still odd then gets the copy from the ring back
+
+# The indexes are kept up to date by sync(). It compares the version in the header with the last version the worker has synced,
+# and puts the items of the ring entries in between into the store. The ring has the item from before each write, which is
+# the old item the store and its listeners take out of their indexes. sync() copies what it needs under a shared lock, so
+# no write is half done while it reads, and then updates the indexes without it
+# main.py runs sync() before every request, when nothing changed it's one read of the header, and every FOLLOW_INTERVAL so an
+# idle worker keeps up. A write that would go around the ring past a worker that hasn't synced yet waits for it, for up to
+# WAIT seconds, then fails with SharedItemsBusy. A worker that starts reads every record once, in sync() from the lifespan
+
+import asyncio
+import fcntl
+import json
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator
+
+MAGIC = b"ITEMSHM2"
+HEADER = struct.Struct("<8sIIIIQQ") # magic, capacity, record size, ring size, worker slots, next item_id, version
+SLOT = struct.Struct("<QQ") # pid (0 when free), last version synced
+RING_ENTRY = struct.Struct("<Q") # item_id, followed by the record from before the write
+RECORD = struct.Struct("<IIQdd?HHH") # seqlock counter, writer pid, version, price, tax, has tax, name, description and tags lengths
+NAME_SIZE = 64
+DESCRIPTION_SIZE = 256
+TAGS_SIZE = 128
+RECORD_SIZE = RECORD.size + NAME_SIZE + DESCRIPTION_SIZE + TAGS_SIZE
+RING_ENTRY_SIZE = RING_ENTRY.size + RECORD_SIZE
+RING_SIZE = 16384
+WORKER_SLOTS = 64
+CAPACITY = 262144
+NO_DESCRIPTION = 0xFFFF # description length of an item whose description is None
+SPINS = 1000 # reads of a record being written before read() waits for the lock
+WAIT = 1.0 # seconds a write waits for a worker that is a whole ring behind
+FOLLOW_INTERVAL = 0.01
+SLOTS = struct.Struct("<%dQ" % (2 * WORKER_SLOTS)) # all the slots at once
+
+
+class SharedItemsError(ValueError):
+    pass
+
+
+class SharedItemsBusy(SharedItemsError):
+    pass
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedRecords:
+    # The records mapping of an ItemStore whose items are in the shared file (get, [], in, iter like a dict)
+    # The store writes the item itself through SharedItems, so setting one here has nothing left to do
+    def __init__(self, shared: "SharedItems") -> None:
+        self.shared = shared
+
+    def get(self, item_id: int, default: Any = None) -> Any:
+        shared = self.shared
+        if item_id in shared._old:
+            # sync() is putting a newer item in the store, which asks for the one its indexes have
+            item = shared._old[item_id]
+        elif isinstance(item_id, int) and 1 <= item_id <= shared.capacity:
+            found = shared.read(item_id)
+            item = found[0] if found is not None else None
+        else:
+            item = None
+        return item if item is not None else default
+
+    def __getitem__(self, item_id: int) -> Any:
+        item = self.get(item_id)
+        if item is None:
+            raise KeyError(item_id)
+        return item
+
+    def __contains__(self, item_id: object) -> bool:
+        return self.get(item_id) is not None
+
+    def __setitem__(self, item_id: int, item: Any) -> None:
+        pass
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __iter__(self) -> Iterator[int]:
+        shared = self.shared
+        next_id, _ = shared._header()
+        for item_id in range(1, min(next_id, shared.capacity + 1)):
+            if struct.unpack_from("<Q", shared._mm, shared._offset(item_id) + 8)[0]:
+                yield item_id
+
+
+class SharedItems:
+    def __init__(self, path: str, capacity: int = CAPACITY) -> None:
+        self.store: Any = None # the worker's ItemStore and its item class, set by attach()
+        self.model: Any = None
+        self.pid = os.getpid()
+        self.writer_pid: int | None = None # the pid that wrote the item being put in the store, while sync() puts it
+        self._file = open(path, "a+b")
+        with self._locked():
+            self._file.seek(0, os.SEEK_END)
+            if self._file.tell() == 0:
+                size = HEADER.size + WORKER_SLOTS * SLOT.size + RING_SIZE * RING_ENTRY_SIZE + capacity * RECORD_SIZE
+                self._file.truncate(size)
+                self._mm = mmap.mmap(self._file.fileno(), size)
+                HEADER.pack_into(self._mm, 0, MAGIC, capacity, RECORD_SIZE, RING_SIZE, WORKER_SLOTS, 1, 0)
+            else:
+                self._mm = mmap.mmap(self._file.fileno(), 0)
+        magic, self.capacity, record_size, ring_size, slots, _, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or record_size != RECORD_SIZE or ring_size != RING_SIZE or slots != WORKER_SLOTS:
+            raise SharedItemsError(f"{path} isn't a shared item file with this layout")
+        self._slots = HEADER.size
+        self._ring = self._slots + WORKER_SLOTS * SLOT.size
+        self._records = self._ring + RING_SIZE * RING_ENTRY_SIZE
+        self._slot: int | None = None # this worker's slot, taken by the first sync()
+        self._joined = False
+        self._seen = 0
+        self._old: dict[int, Any] = {} # item_id -> the item the store has, while sync() puts a newer one
+        self.records = SharedRecords(self)
+
+    def attach(self, store: Any, model: Any) -> None:
+        # store is the ItemStore created with self.records, model the class its items are built with
+        self.store = store
+        self.model = model
+
+    @contextmanager
+    def _locked(self, shared: bool = False) -> Iterator[None]:
+        fcntl.flock(self._file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _header(self) -> tuple[int, int]:
+        # (next item_id, version)
+        return struct.unpack_from("<QQ", self._mm, HEADER.size - 16)
+
+    def _offset(self, item_id: int) -> int:
+        if not 1 <= item_id <= self.capacity:
+            raise SharedItemsError(f"item_id must be between 1 and {self.capacity} when items are shared")
+        return self._records + (item_id - 1) * RECORD_SIZE
+
+    def _ring_offset(self, version: int) -> int:
+        return self._ring + (version % RING_SIZE) * RING_ENTRY_SIZE
+
+    def insert(self, item: Any) -> int:
+        # Like ItemStore.insert, the id comes from the shared header so it's unique across workers
+        return self._write_when_room(None, item)
+
+    def put(self, item_id: int, item: Any) -> None:
+        # Like ItemStore.put
+        self._offset(item_id)
+        self._write_when_room(item_id, item)
+
+    def _write_when_room(self, item_id: int | None, item: Any) -> int:
+        deadline = time.monotonic() + WAIT
+        while True:
+            with self._locked():
+                next_id, version = self._header()
+                if self._has_room(version):
+                    if item_id is None:
+                        item_id = next_id
+                    self._write(item_id, item, version)
+                    if item_id >= next_id:
+                        struct.pack_into("<Q", self._mm, HEADER.size - 16, item_id + 1)
+                    # This write and the ones before it go into the store now, without taking the lock again in sync()
+                    synced = self._changes() if self._slot is not None else None
+                    break
+            if time.monotonic() > deadline:
+                raise SharedItemsBusy("another worker is too far behind on the shared items, try again")
+            self.sync() # in case the worker that is behind is this one
+            time.sleep(0.001)
+        if synced is not None:
+            self._apply(*synced)
+        else:
+            self.sync()
+        return item_id
+
+    def _has_room(self, version: int) -> bool:
+        # Whether ring[version % RING_SIZE] can be overwritten, i.e. every worker has synced the write that is there now
+        slots = SLOTS.unpack_from(self._mm, self._slots)
+        for slot in range(WORKER_SLOTS):
+            pid, seen = slots[2 * slot], slots[2 * slot + 1]
+            if pid == 0 or version - seen < RING_SIZE:
+                continue
+            if pid != self.pid and not alive(pid):
+                SLOT.pack_into(self._mm, self._slots + slot * SLOT.size, 0, 0) # a worker that exited without close()
+                continue
+            return False
+        return True
+
+    def _write(self, item_id: int, item: Any, version: int) -> None:
+        offset = self._offset(item_id)
+        name = item.name.encode()
+        description = item.description.encode() if item.description is not None else b""
+        tags = json.dumps(item.tags, ensure_ascii=False, separators=(",", ":")).encode()
+        for field, value, size in (("name", name, NAME_SIZE), ("description", description, DESCRIPTION_SIZE), ("tags", tags, TAGS_SIZE)):
+            if len(value) > size:
+                raise SharedItemsError(f"{field} is longer than the {size} bytes a shared item has room for")
+        mm = self._mm
+        seq = struct.unpack_from("<I", mm, offset)[0]
+        if seq & 1:
+            # We hold the lock, so the worker that left it odd died while writing it
+            self._repair(offset, version)
+            seq = struct.unpack_from("<I", mm, offset)[0]
+        # The record as it is now goes to the ring first, for the workers to take out of their indexes and for _repair
+        ring = self._ring_offset(version)
+        RING_ENTRY.pack_into(mm, ring, item_id)
+        mm[ring + RING_ENTRY.size : ring + RING_ENTRY_SIZE] = mm[offset : offset + RECORD_SIZE]
+        struct.pack_into("<I", mm, offset, seq + 1) # odd: readers wait
+        RECORD.pack_into(
+            mm,
+            offset,
+            seq + 1,
+            self.pid,
+            version + 1,
+            item.price,
+            item.tax if item.tax is not None else math.nan,
+            item.tax is not None,
+            len(name),
+            len(description) if item.description is not None else NO_DESCRIPTION,
+            len(tags),
+        )
+        data = offset + RECORD.size
+        mm[data : data + len(name)] = name
+        data += NAME_SIZE
+        mm[data : data + len(description)] = description
+        data += DESCRIPTION_SIZE
+        mm[data : data + len(tags)] = tags
+        struct.pack_into("<I", mm, offset, seq + 2) # even again: the record is complete
+        # The version last, so a reader that sees it finds the ring entry and the record
+        struct.pack_into("<Q", mm, HEADER.size - 8, version + 1)
+
+    def _repair(self, offset: int, version: int) -> None:
+        # Called with the lock held on a record a dead writer left odd. It died before counting its write in the version,
+        # so its ring entry is ring[version] and has the record from before it started, which is put back
+        mm = self._mm
+        seq = struct.unpack_from("<I", mm, offset)[0]
+        ring = self._ring_offset(version)
+        mm[offset : offset + RECORD_SIZE] = mm[ring + RING_ENTRY.size : ring + RING_ENTRY_SIZE]
+        struct.pack_into("<I", mm, offset, seq + 1)
+
+    def read(self, item_id: int) -> tuple[Any, int] | None:
+        # The item and the pid of the worker that wrote it, or None if there's no item with this id
+        offset = self._offset(item_id)
+        for _ in range(SPINS):
+            record = self._read_record(offset)
+            if record is not None:
+                break
+        else:
+            # Still odd after SPINS tries: either a slow writer, which holds the lock, or a writer that died in the middle of
+            # the record. Once the lock is ours no one is writing, so a record that is still odd belongs to a dead writer
+            with self._locked():
+                if struct.unpack_from("<I", self._mm, offset)[0] & 1:
+                    self._repair(offset, self._header()[1])
+                record = self._read_record(offset)
+        return self._decode(record)
+
+    def _read_record(self, offset: int) -> bytes | None:
+        # One try of the seqlock: a copy of the record, or None when a writer was in the middle of it
+        mm = self._mm
+        seq = struct.unpack_from("<I", mm, offset)[0]
+        if seq & 1:
+            return None
+        record = mm[offset : offset + RECORD_SIZE]
+        if struct.unpack_from("<I", mm, offset)[0] != seq:
+            return None
+        return record
+
+    def _decode(self, record: bytes) -> tuple[Any, int] | None:
+        _, pid, version, price, tax, has_tax, name_len, description_len, tags_len = RECORD.unpack_from(record)
+        if version == 0:
+            return None
+        data = RECORD.size
+        name = record[data : data + name_len].decode()
+        data += NAME_SIZE
+        description = record[data : data + description_len].decode() if description_len != NO_DESCRIPTION else None
+        data += DESCRIPTION_SIZE
+        tags = json.loads(record[data : data + tags_len])
+        # model_construct, like item_columns.ItemColumns: the item was validated by the worker that wrote it
+        item = self.model.model_construct(name=name, description=description, price=price, tax=tax if has_tax else None, tags=tags)
+        return item, pid
+
+    def sync(self) -> None:
+        # Puts the items other workers wrote since the last sync into the local store
+        if self.store is None:
+            return
+        if self._slot is None:
+            self._join()
+            return
+        _, version = self._header()
+        if version == self._seen:
+            return
+        with self._locked(shared=True):
+            changes, version = self._changes()
+        self._apply(changes, version)
+
+    def _changes(self) -> tuple[list[tuple[int, bytes, bytes]], int]:
+        # With the lock held: the writes since the last sync, as (item_id, record before, record after), and the version
+        mm = self._mm
+        _, version = self._header()
+        entries = []
+        for v in range(self._seen, version):
+            ring = self._ring_offset(v)
+            entries.append((RING_ENTRY.unpack_from(mm, ring)[0], mm[ring + RING_ENTRY.size : ring + RING_ENTRY_SIZE]))
+        # The record from before a write is the one the store has, the record after it is the one from before the next
+        # write of the same item, or the record in the file for its last write
+        following = {item_id: mm[self._offset(item_id) : self._offset(item_id) + RECORD_SIZE] for item_id, _ in entries}
+        changes = []
+        for item_id, before in reversed(entries):
+            changes.append((item_id, before, following[item_id]))
+            following[item_id] = before
+        changes.reverse()
+        return changes, version
+
+    def _apply(self, changes: list[tuple[int, bytes, bytes]], version: int) -> None:
+        for item_id, before, after in changes:
+            found = self._decode(after)
+            if found is None:
+                continue
+            old = self._decode(before)
+            self._old[item_id] = old[0] if old is not None else None
+            item, self.writer_pid = found
+            try:
+                self.store.put(item_id, item)
+            finally:
+                self.writer_pid = None
+                del self._old[item_id]
+        self._synced(version)
+
+    def _join(self) -> None:
+        # First sync of this worker: takes a slot and puts every item in the file into the store
+        # After close() (e.g. the app is started again in the same process) the store has the items up to the last sync,
+        # so it takes a slot at that version and syncs from there, as long as the ring still has the writes since then
+        with self._locked():
+            next_id, version = self._header()
+            rejoin = self._joined
+            if rejoin and version - self._seen > RING_SIZE:
+                raise SharedItemsError("this worker missed too many writes to the shared items while it was closed")
+            for slot in range(WORKER_SLOTS):
+                offset = self._slots + slot * SLOT.size
+                pid, _ = SLOT.unpack_from(self._mm, offset)
+                if pid == 0 or pid == self.pid or not alive(pid):
+                    SLOT.pack_into(self._mm, offset, self.pid, self._seen if rejoin else version)
+                    break
+            else:
+                raise SharedItemsError(f"more than {WORKER_SLOTS} workers share {self._file.name}")
+            self._slot = slot
+            self._joined = True
+            if not rejoin:
+                records = [(item_id, self._mm[self._offset(item_id) : self._offset(item_id) + RECORD_SIZE]) for item_id in range(1, min(next_id, self.capacity + 1))]
+        if rejoin:
+            self.sync()
+            return
+        for item_id, record in records:
+            found = self._decode(record)
+            if found is None:
+                continue
+            self._old[item_id] = None
+            item, self.writer_pid = found
+            try:
+                self.store.put(item_id, item)
+            finally:
+                self.writer_pid = None
+                del self._old[item_id]
+        self._synced(version)
+
+    def _synced(self, version: int) -> None:
+        self._seen = version
+        struct.pack_into("<Q", self._mm, self._slots + self._slot * SLOT.size + 8, version)
+
+    async def follow(self, interval: float = FOLLOW_INTERVAL) -> None:
+        # Runs for as long as the app does (main.py starts it in the lifespan), so a worker without requests keeps up too
+        while True:
+            self.sync()
+            await asyncio.sleep(interval)
+
+    def local_writes(self, listener: Callable[[int, Any | None, Any], None]) -> Callable[[int, Any | None, Any], None]:
+        # Wraps an ItemStore listener so it only sees the writes made by this worker, e.g. so only one worker saves an item to ITEMS_DB
+        def local_listener(item_id: int, old_item: Any | None, new_item: Any) -> None:
+            if self.writer_pid in (None, self.pid):
+                listener(item_id, old_item, new_item)
+
+        return local_listener
+
+    def hook(self, route: Any, handler: Callable) -> Callable:
+        # Route hook, brings the local store up to date before every request
+        async def synced_handler(request: Any) -> Any:
+            self.sync()
+            return await handler(request)
+
+        return synced_handler
+
+    def close(self) -> None:
+        # Gives the worker's slot back, so writers don't wait for it. The file stays mapped, the store reads its items from it
+        if self._slot is not None:
+            with self._locked():
+                SLOT.pack_into(self._mm, self._slots + self._slot * SLOT.size, 0, 0)
+            self._slot = None
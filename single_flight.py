@@ -0,0 +1,71 @@
+# Request coalescing ("single flight") for GET path operations
+# When many identical requests arrive at the same time (e.g. a burst after a cached response expired), each one runs the
+# path operation, and they all compute the same response
+
+# Turn it on for a path operation with @single_flight.coalesced() under the @app.get(...) line
+# The first request for a key (the path, its parameters and the sorted query, like the response cache) runs the handler
+# Identical requests that arrive while it runs wait for it and get a copy of its response, so the function runs once per burst
+# Requests only overlap while the handler is suspended (awaiting I/O), a handler that never awaits is done before the next request arrives
+# Nothing is kept after the response is sent, it only merges requests that overlap in time
+
+# If the first request fails (an exception, a 5xx, a streamed response that can't be copied) or is cancelled because its client went away,
+# the waiting requests aren't given its result: each of them runs the handler itself, so an error is never shared or kept
+
+import asyncio
+from typing import Callable
+
+from fastapi import Request, Response
+from fastapi.routing import APIRoute
+
+from response_cache import ResponseCache
+from route_hooks import Handler, route_option
+
+OPTION = "__single_flight__"
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        # key -> future of (status_code, raw_headers, body), or None when the response can't be shared
+        self._flights: dict[tuple, asyncio.Future] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def coalesced(self) -> Callable:
+        return route_option(OPTION)
+
+    def hook(self, route: APIRoute, handler: Handler) -> Handler:
+        if getattr(route.endpoint, OPTION, None) is None or "GET" not in route.methods:
+            return handler
+
+        async def coalesced_handler(request: Request) -> Response:
+            if request.method != "GET":
+                return await handler(request)
+            key = ResponseCache.key(route.path, request)
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.followers += 1
+                shared = await asyncio.shield(flight) # the leader being cancelled doesn't cancel this request
+                if shared is None:
+                    return await handler(request)
+                status_code, headers, body = shared
+                response = Response(content=body, status_code=status_code)
+                response.raw_headers = list(headers)
+                return response
+            self.leaders += 1
+            flight = self._flights[key] = asyncio.get_running_loop().create_future()
+            shared = None
+            try:
+                response = await handler(request)
+                body = getattr(response, "body", None)
+                if body is not None and response.status_code < 500:
+                    shared = (response.status_code, list(response.raw_headers), body)
+                return response
+            finally:
+                # Also runs on an exception or a cancellation, so the waiting requests always wake up
+                del self._flights[key]
+                flight.set_result(shared)
+
+        return coalesced_handler
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "leaders": self.leaders, "followers": self.followers}
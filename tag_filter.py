@@ -0,0 +1,144 @@
+# Filtering items by their tags, for GET /items/?tag=foo&tag=bar in main.py
+# Every tag has a bitmap of the items that have it: bit n is set when item n has the tag
+# Combining filters is then a few bitwise operations: all the tags is AND, any of the tags is OR, leaving out tags is AND NOT
+# Python ints are arbitrary size bitsets and & | ~ on them run in C a machine word at a time, instead of looping over items
+
+# The bitmaps are split in chunks of 65536 ids (like Roaring bitmaps), and chunks with no items aren't stored,
+# so a rare tag only takes the chunks its items are in, and adding an item to a tag copies one chunk, not the whole bitmap
+# The result is a Bitmap too. ItemStore.page uses it to page through the matching items in id order, reading the set bits
+# from the cursor on, so a page costs about the same however many items match
+
+import sys
+from typing import Any, Iterable, Iterator
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+CHUNK_MASK = CHUNK_SIZE - 1
+
+
+class Bitmap:
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks: dict[int, int] | None = None) -> None:
+        self.chunks = chunks if chunks is not None else {} # chunk number -> bits of the ids in that chunk
+
+    @classmethod
+    def of(cls, ids: Iterable[int]) -> "Bitmap":
+        bitmap = cls()
+        for item_id in ids:
+            bitmap.add(item_id)
+        return bitmap
+
+    def add(self, item_id: int) -> None:
+        chunk = item_id >> CHUNK_BITS
+        self.chunks[chunk] = self.chunks.get(chunk, 0) | (1 << (item_id & CHUNK_MASK))
+
+    def discard(self, item_id: int) -> None:
+        chunk = item_id >> CHUNK_BITS
+        bits = self.chunks.get(chunk, 0) & ~(1 << (item_id & CHUNK_MASK))
+        if bits:
+            self.chunks[chunk] = bits
+        else:
+            self.chunks.pop(chunk, None)
+
+    def __contains__(self, item_id: int) -> bool:
+        return bool(self.chunks.get(item_id >> CHUNK_BITS, 0) >> (item_id & CHUNK_MASK) & 1)
+
+    def __len__(self) -> int:
+        return sum(bits.bit_count() for bits in self.chunks.values())
+
+    def __bool__(self) -> bool:
+        return bool(self.chunks)
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        small, big = sorted((self.chunks, other.chunks), key=len)
+        return Bitmap({chunk: bits for chunk, bits in ((c, b & big.get(c, 0)) for c, b in small.items()) if bits})
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        chunks = dict(self.chunks)
+        for chunk, bits in other.chunks.items():
+            chunks[chunk] = chunks.get(chunk, 0) | bits
+        return Bitmap(chunks)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        chunks = {}
+        for chunk, bits in self.chunks.items():
+            bits &= ~other.chunks.get(chunk, 0)
+            if bits:
+                chunks[chunk] = bits
+        return Bitmap(chunks)
+
+    def iter_from(self, start: int = 0) -> Iterator[int]:
+        # The ids in the bitmap that are >= start, in increasing order
+        # A chunk is read 64 bits at a time: taking the lowest bit of the whole 8 KB chunk int would copy all of it for every id
+        first_chunk = start >> CHUNK_BITS
+        for chunk in sorted(c for c in self.chunks if c >= first_chunk):
+            bits = self.chunks.get(chunk, 0)
+            first_word = 0
+            if chunk == first_chunk:
+                bits &= ~((1 << (start & CHUNK_MASK)) - 1)
+                first_word = (start & CHUNK_MASK) >> 6
+            words = memoryview(bits.to_bytes(CHUNK_SIZE // 8, sys.byteorder)).cast("Q")
+            last_word = (bits.bit_length() + 63) >> 6
+            base = chunk << CHUNK_BITS
+            for index in range(first_word, last_word):
+                word = words[index]
+                while word:
+                    lowest = word & -word
+                    yield base + (index << 6) + lowest.bit_length() - 1
+                    word ^= lowest
+
+    def __iter__(self) -> Iterator[int]:
+        return self.iter_from(0)
+
+
+class TagIndex:
+    def __init__(self) -> None:
+        self.all_items = Bitmap()
+        self._tags: dict[str, Bitmap] = {}
+
+    def on_write(self, item_id: int, old_item: Any | None, new_item: Any) -> None:
+        # ItemStore listener
+        old_tags = set(old_item.tags) if old_item is not None else set()
+        new_tags = set(new_item.tags)
+        for tag in old_tags - new_tags:
+            bitmap = self._tags[tag]
+            bitmap.discard(item_id)
+            if not bitmap:
+                del self._tags[tag]
+        for tag in new_tags - old_tags:
+            self._tags.setdefault(tag, Bitmap()).add(item_id)
+        self.all_items.add(item_id)
+
+    def count(self, tag: str) -> int:
+        bitmap = self._tags.get(tag)
+        return len(bitmap) if bitmap is not None else 0
+
+    def select(
+        self,
+        tags: list[str] | None = None,
+        match: str = "all",
+        exclude: list[str] | None = None,
+    ) -> Bitmap:
+        # The items with all (match="all") or any (match="any") of tags, without the items that have any of the exclude tags
+        if tags:
+            bitmaps = [self._tags.get(tag, Bitmap()) for tag in dict.fromkeys(tags)]
+            if match == "all":
+                bitmaps.sort(key=lambda bitmap: len(bitmap.chunks)) # the smallest first, so the result shrinks fast
+                result = bitmaps[0]
+                for bitmap in bitmaps[1:]:
+                    if not result:
+                        break
+                    result = result & bitmap
+            else:
+                result = Bitmap()
+                for bitmap in bitmaps:
+                    result = result | bitmap
+        else:
+            result = self.all_items
+        for tag in dict.fromkeys(exclude or ()):
+            bitmap = self._tags.get(tag)
+            if bitmap is not None:
+                result = result - bitmap
+        # A copy, so writes to the index don't change a result that is still being paged through
+        return Bitmap(dict(result.chunks))
@@ -0,0 +1,107 @@
+# Recovery tests for item_journal.py: a cut off last record, snapshots replacing segments, restarts and failed writes
+# Run from the folder with main.py: python -m pytest tests
+
+import asyncio
+import errno
+import os
+
+from pydantic import BaseModel
+
+from item_journal import SEGMENT, SNAPSHOT, ItemJournal
+
+
+class Item(BaseModel):
+    name: str
+    price: float
+
+
+def files(directory, pattern):
+    return sorted(name for name in os.listdir(directory) if pattern.match(name))
+
+
+async def run(directory, writes, snapshot_every=10):
+    # Starts a journal like main.py does, makes the writes, and returns what it loaded at the start
+    items = {}
+    journal = ItemJournal(str(directory), Item, lambda: sorted(items.items()), fsync_interval=0, snapshot_every=snapshot_every)
+    loaded = await journal.load()
+    items.update(loaded)
+    for item_id, item in writes:
+        old = items.get(item_id)
+        items[item_id] = item
+        journal.on_write(item_id, old, item)
+        await journal.sync()
+    await journal.close()
+    return dict(loaded)
+
+
+def test_cut_off_record_is_truncated(tmp_path):
+    asyncio.run(run(tmp_path, [(1, Item(name="a", price=1)), (2, Item(name="b", price=2))]))
+    segment = tmp_path / files(tmp_path, SEGMENT)[-1]
+    good_size = segment.stat().st_size
+    with open(segment, "ab") as file:
+        file.write(b"\x40\x00\x00\x00\x01\x02") # the start of a record, like a crash in the middle of a write
+    loaded = asyncio.run(run(tmp_path, []))
+    assert loaded == {1: Item(name="a", price=1), 2: Item(name="b", price=2)}
+    assert segment.stat().st_size == good_size
+
+
+def test_snapshot_replaces_segments(tmp_path):
+    writes = [(i % 5 + 1, Item(name=f"item {i}", price=i)) for i in range(25)]
+    asyncio.run(run(tmp_path, writes))
+    snapshots = files(tmp_path, SNAPSHOT)
+    assert len(snapshots) == 1
+    # Only the segments written after the snapshot are left
+    assert all(int(SEGMENT.match(name).group(1)) > int(SNAPSHOT.match(snapshots[0]).group(1)) for name in files(tmp_path, SEGMENT))
+    loaded = asyncio.run(run(tmp_path, []))
+    assert loaded == {i % 5 + 1: Item(name=f"item {i}", price=i) for i in range(20, 25)}
+
+
+def test_restarts_count_toward_snapshots(tmp_path):
+    # Fewer writes than snapshot_every per run, but the replayed records add up, so the history doesn't grow with restarts
+    for run_number in range(6):
+        loaded = asyncio.run(run(tmp_path, [(1, Item(name=f"run {run_number}", price=i)) for i in range(8)]))
+    assert loaded == {1: Item(name="run 4", price=7)}
+    assert files(tmp_path, SNAPSHOT)
+    assert len(files(tmp_path, SEGMENT)) <= 2
+    asyncio.run(run(tmp_path, []))
+    assert len(files(tmp_path, SEGMENT)) <= 2 # a run without writes doesn't leave an empty segment behind
+
+
+class FullDisk:
+    # Wraps a segment file: a write stores part of the records and fails, and the file can't be cut back either
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data[: len(data) // 2])
+        self.file.flush()
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def truncate(self, size):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+def test_writes_after_a_failed_write_survive(tmp_path):
+    async def scenario():
+        items = {}
+        journal = ItemJournal(str(tmp_path), Item, lambda: sorted(items.items()), fsync_interval=0)
+        await journal.load()
+        journal.on_write(1, None, Item(name="a", price=1))
+        await journal.sync()
+        journal._segment = FullDisk(journal._segment)
+        journal.on_write(2, None, Item(name="lost", price=2))
+        try:
+            await journal.sync()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("the failed write wasn't reported")
+        journal.on_write(3, None, Item(name="c", price=3)) # acknowledged, so it has to be there after a restart
+        await journal.sync()
+        await journal.close()
+
+    asyncio.run(scenario())
+    assert asyncio.run(run(tmp_path, [])) == {1: Item(name="a", price=1), 3: Item(name="c", price=3)}
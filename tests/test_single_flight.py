@@ -0,0 +1,73 @@
+# Tests for single_flight.py: identical requests that overlap share one run of the handler, failures aren't shared
+# Run from the folder with main.py: python -m pytest tests
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import FastAPI, HTTPException
+
+import route_hooks
+from route_hooks import HookedRoute
+from single_flight import SingleFlight
+
+
+@pytest.fixture
+def flight(monkeypatch):
+    flight = SingleFlight()
+    monkeypatch.setattr(route_hooks, "_hooks", [flight.hook]) # only this hook, whatever else registered hooks
+    return flight
+
+
+def make_app(flight, endpoint):
+    app = FastAPI()
+    app.router.route_class = HookedRoute
+    app.get("/things/{name}")(flight.coalesced()(endpoint))
+    return app
+
+
+async def get_all(app, paths):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        return await asyncio.gather(*(client.get(path) for path in paths))
+
+
+def test_overlapping_requests_share_one_run(flight):
+    runs = []
+
+    async def read_thing(name: str):
+        runs.append(name)
+        run = len(runs)
+        await asyncio.sleep(0.05) # e.g. a database query, the other requests arrive meanwhile
+        return {"name": name, "run": run}
+
+    app = make_app(flight, read_thing)
+    responses = asyncio.run(get_all(app, ["/things/a"] * 20 + ["/things/b"] * 5))
+    assert runs == ["a", "b"]
+    assert [response.json() for response in responses] == [{"name": "a", "run": 1}] * 20 + [{"name": "b", "run": 2}] * 5
+    assert flight.stats() == {"in_flight": 0, "leaders": 2, "followers": 23}
+
+
+def test_handler_that_never_suspends_is_not_coalesced(flight):
+    # It finishes before the next request gets to the hook, so there is never a flight to join
+    async def read_thing(name: str):
+        return {"name": name}
+
+    app = make_app(flight, read_thing)
+    asyncio.run(get_all(app, ["/things/a"] * 10))
+    assert flight.stats() == {"in_flight": 0, "leaders": 10, "followers": 0}
+
+
+def test_failed_run_is_not_shared(flight):
+    runs = []
+
+    async def read_thing(name: str):
+        runs.append(name)
+        await asyncio.sleep(0.05)
+        if len(runs) == 1:
+            raise HTTPException(status_code=503, detail="try again")
+        return {"name": name}
+
+    app = make_app(flight, read_thing)
+    responses = asyncio.run(get_all(app, ["/things/a"] * 3))
+    assert [response.status_code for response in responses] == [503, 200, 200]
+    assert len(runs) == 3 # the waiting requests ran the handler themselves